@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for the personal data redaction helpers
+
+Run without arguments to print the comparisons, or with --json PATH to
+run the suite and write its results as JSON
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import re
+import string
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from typing import Callable, List
+
+filtered_logger = __import__('filtered_logger')
+
+
+def legacy_filter_datum(fields: List[str], redaction: str,
+                        message: str, separator: str) -> str:
+    """ filter_datum as it was before the single-pass engine """
+    for f in fields:
+        message = re.sub(f'{f}=.*?{separator}',
+                         f'{f}={redaction}{separator}', message)
+    return message
+
+
+def sample_row() -> dict:
+    """ Returns a row of user_data.csv """
+    return {"name": "Marlene Wood", "email": "hwestiii@att.net",
+            "phone": "(473) 401-4253", "ssn": "261-72-6780",
+            "password": "K5?BMNv",
+            "ip": "60ed:c396:2ff:244:bbd0:9208:26f2:93ea",
+            "last_login": "2019-11-14 06:14:24",
+            "user_agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+            "AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/74.0.3729.157 Safari/537.36"}
+
+
+def sample_message() -> str:
+    """ Returns a message shaped like a row of user_data.csv """
+    return ' '.join(f'{k}={v};' for k, v in sample_row().items())
+
+
+def bench_filter_datum(number: int = 100000) -> None:
+    """ Compares the legacy and the single-pass filter_datum """
+    fields = list(filtered_logger.PII_FIELDS)
+    message = sample_message()
+    expected = legacy_filter_datum(fields, '***', message, ';')
+    assert filtered_logger.filter_datum(fields, '***',
+                                        message, ';') == expected
+
+    for name, func in (("legacy", legacy_filter_datum),
+                       ("single-pass", filtered_logger.filter_datum)):
+        seconds = timeit.timeit(lambda: func(fields, '***', message, ';'),
+                                number=number)
+        print("filter_datum {:<12} {:>10.0f} msg/s".format(
+            name, number / seconds))
+
+
+def bench_structured(number: int = 100000) -> None:
+    """ Compares filter_datum with the redaction of a mapping message """
+    message = sample_message()
+    row = sample_row()
+    formatter = filtered_logger.RedactingFormatter(
+        list(filtered_logger.PII_FIELDS))
+    assert formatter.redact_items(row.items()) == filtered_logger.filter_datum(
+        formatter.fields, '***', message, ';')
+
+    cases = (("filter_datum", lambda: filtered_logger.filter_datum(
+        formatter.fields, '***', message, ';')),
+        ("mapping", lambda: formatter.redact_items(row.items())))
+    for name, func in cases:
+        seconds = timeit.timeit(func, number=number)
+        print("redact {:<18} {:>10.0f} msg/s".format(name, number / seconds))
+
+
+def bench_detectors(kilobytes: int = 256) -> None:
+    """ Measures the cost per KB of log text of the content detectors """
+    line = ("user 42 failed login from 192.168.1.25, contact "
+            "hwestiii@att.net or (473) 401-4253, ssn 261-72-6780, "
+            "agent Mozilla/5.0 (Windows NT 10.0; Win64; x64)\n")
+    text = line * (kilobytes * 1024 // len(line))
+    size = len(text) / 1024
+    fields = list(filtered_logger.PII_FIELDS)
+    detectors = filtered_logger.RedactingFormatter.DETECTORS
+    for enabled in ((), ("email",), tuple(detectors)):
+        formatter = filtered_logger.RedactingFormatter(fields,
+                                                       detectors=enabled)
+        seconds = min(timeit.repeat(lambda: formatter.detect(text),
+                                    number=1, repeat=5))
+        print("detectors {:<26} {:>8.2f} us/KB".format(
+            ",".join(enabled) or "none", seconds * 1e6 / size))
+
+
+def sqlite_users(rows: int, directory: str) -> str:
+    """
+    Creates a SQLite stand-in holding rows copies of the main.sql users
+    and points get_db at it
+    Return:
+        path of the database file
+    """
+    db_path = os.path.join(directory, "users.sqlite3")
+    os.environ["PERSONAL_DATA_DB_ENGINE"] = "sqlite"
+    os.environ["PERSONAL_DATA_SQLITE_PATH"] = db_path
+    db = filtered_logger.get_sqlite_db(db_path)
+    seed = db.execute("SELECT * FROM users;").fetchall()
+    marks = ", ".join("?" * len(seed[0]))
+    db.executemany("INSERT INTO users VALUES ({});".format(marks),
+                   (seed[i % len(seed)] for i in range(rows - len(seed))))
+    db.commit()
+    db.close()
+    return db_path
+
+
+def bench_export(rows: int = 200000, workers: int = 4) -> None:
+    """ Compares the serial and the parallel export of the users table """
+    with tempfile.TemporaryDirectory() as directory, \
+            open(os.devnull, "w") as out:
+        sqlite_users(rows, directory)
+
+        start = time.perf_counter()
+        db = filtered_logger.get_db()
+        filtered_logger.export_users(db, out)
+        db.close()
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        filtered_logger.export_users_parallel(out, workers=workers)
+        parallel = time.perf_counter() - start
+
+    print("export serial          {:>10.0f} rows/s".format(rows / serial))
+    print("export {} workers      {:>10.0f} rows/s (x{:.2f})".format(
+        workers, rows / parallel, serial / parallel))
+
+
+def bench_get_db(number: int = 2000, pool_size: int = 4) -> None:
+    """ Compares a new connection per call with a pooled get_db """
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite_users(10, directory)
+        for size in (0, pool_size):
+            os.environ["PERSONAL_DATA_DB_POOL_SIZE"] = str(size)
+            start = time.perf_counter()
+            for _ in range(number):
+                with filtered_logger.db_connection() as db:
+                    cursor = db.cursor()
+                    cursor.execute("SELECT COUNT(*) FROM users;")
+                    cursor.fetchall()
+                    cursor.close()
+            elapsed = time.perf_counter() - start
+            print("get_db pool size {:<6} {:>10.0f} queries/s".format(
+                size, number / elapsed))
+        filtered_logger.get_pool().close()
+        del os.environ["PERSONAL_DATA_DB_POOL_SIZE"]
+
+
+def synthetic_record(field_count: int, value_length: int,
+                     rng: random.Random) -> dict:
+    """
+    Returns a record with the PII_FIELDS first, then extra fields up to
+    field_count, every value value_length characters long
+    """
+    names = list(filtered_logger.PII_FIELDS)[:field_count]
+    names += ["field_{}".format(i) for i in range(field_count - len(names))]
+    alphabet = string.ascii_letters + string.digits + " .@-()"
+    return {name: ''.join(rng.choice(alphabet) for _ in range(value_length))
+            for name in names}
+
+
+def measure(func: Callable, number: int) -> dict:
+    """
+    Measures func called number times
+    Return:
+        operations per second, best of 3 runs, and the largest amount of
+        memory a call allocated at once, in bytes
+    """
+    seconds = min(timeit.repeat(func, number=number, repeat=3))
+    tracemalloc.start()
+    peak = 0
+    for _ in range(min(number, 1000)):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return {"ops_per_sec": number / seconds, "peak_bytes": peak}
+
+
+def run_suite(number: int = 20000, rows: int = 100000) -> dict:
+    """
+    Benchmarks filter_datum, RedactingFormatter.format and the export
+    of the users table on synthetic records of several shapes
+    Return:
+        the results, ready to be dumped as JSON
+    """
+    rng = random.Random(0)
+    fields = list(filtered_logger.PII_FIELDS)
+    formatter = filtered_logger.RedactingFormatter(fields)
+    results = []
+    for field_count in (5, 10, 20):
+        for value_length in (8, 32, 128):
+            record = synthetic_record(field_count, value_length, rng)
+            message = ' '.join(f'{k}={v};' for k, v in record.items())
+            cases = {
+                "filter_datum": lambda: filtered_logger.filter_datum(
+                    fields, '***', message, ';'),
+                "formatter": lambda: formatter.format(logging.LogRecord(
+                    "user_data", logging.INFO, None, None, message, None,
+                    None)),
+                "formatter_mapping": lambda: formatter.format(
+                    logging.LogRecord("user_data", logging.INFO, None, None,
+                                      record, None, None)),
+            }
+            for name, func in cases.items():
+                result = {"name": name, "fields": field_count,
+                          "value_length": value_length,
+                          "message_length": len(message)}
+                result.update(measure(func, number))
+                results.append(result)
+
+    with tempfile.TemporaryDirectory() as directory, \
+            open(os.devnull, "w") as out:
+        sqlite_users(rows, directory)
+        db = filtered_logger.get_db()
+        result = {"name": "export_users", "rows": rows}
+        result.update(measure(lambda: filtered_logger.export_users(db, out),
+                              1))
+        result["rows_per_sec"] = result.pop("ops_per_sec") * rows
+        results.append(result)
+        db.close()
+
+    return {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "python": sys.version.split()[0],
+                     "platform": platform.platform(),
+                     "number": number},
+            "results": results}
+
+
+def main(argv: List[str] = None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description="Benchmarks the personal "
+                                     "data redaction helpers")
+    parser.add_argument("--json", help="run the suite and write its "
+                        "results to this file")
+    parser.add_argument("--number", type=int, default=20000,
+                        help="calls per suite measurement")
+    parser.add_argument("--rows", type=int, default=100000,
+                        help="rows of the suite export")
+    args = parser.parse_args(argv)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(run_suite(args.number, args.rows), f, indent=2)
+        return
+    bench_filter_datum()
+    bench_structured()
+    bench_detectors()
+    bench_export()
+    bench_get_db()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,84 @@
 Defines a hash_password function to return a hashed password
 Task 5 6
 """
+import asyncio
 import bcrypt
 from bcrypt import hashpw
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+import logging
+from os import environ
+import time
+from typing import Any, Callable, Iterable, List, Tuple
+
+# lowest cost calibration may pick, however slow the machine looks
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+# cost without a configured budget, the default of bcrypt.gensalt
+DEFAULT_ROUNDS = 12
+# timings per cost, the fastest one counts
+SAMPLES = 3
+_rounds = None
+_rehasher = ThreadPoolExecutor(max_workers=1)
+
+
+def calibrate_rounds(budget_ms: float = None, min_rounds: int = MIN_ROUNDS,
+                     max_rounds: int = MAX_ROUNDS) -> int:
+    """
+    Measures bcrypt on this machine and sets the cost used to hash
+    Args:
+        budget_ms (float): hashing time to fit in, BCRYPT_BUDGET_MS by
+            default; without either the cost is DEFAULT_ROUNDS
+        min_rounds (int): lowest cost, used even above the budget
+        max_rounds (int): highest cost
+    Return:
+        the highest cost hashing within the budget
+    """
+    global _rounds
+    if budget_ms is None and "BCRYPT_BUDGET_MS" not in environ:
+        _rounds = max(min_rounds, DEFAULT_ROUNDS)
+        return _rounds
+    if budget_ms is None:
+        budget_ms = float(environ["BCRYPT_BUDGET_MS"])
+    rounds = min_rounds
+    elapsed = _time_hash(rounds)
+    # every extra round doubles the hashing time
+    while rounds < max_rounds and elapsed * 2 <= budget_ms:
+        elapsed = _time_hash(rounds + 1)
+        if elapsed > budget_ms:
+            break
+        rounds += 1
+    _rounds = rounds
+    return rounds
+
+
+def _time_hash(rounds: int) -> float:
+    """
+    Returns the milliseconds a hash takes at the given cost, the best of
+    SAMPLES runs so a busy moment does not lower the cost for good
+    """
+    best = None
+    for _ in range(SAMPLES):
+        start = time.perf_counter()
+        hashpw(b"calibration", bcrypt.gensalt(rounds))
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def get_rounds() -> int:
+    """
+    Returns the calibrated cost, calibrating on first use: at import
+    already when BCRYPT_BUDGET_MS is set
+    """
+    if _rounds is None:
+        return calibrate_rounds()
+    return _rounds
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """ Tells whether a hash was made with a lower cost than the current """
+    return int(hashed_password.split(b"$")[2]) < get_rounds()
 
 
 def hash_password(password: str) -> bytes:
@@ -14,17 +90,117 @@ def hash_password(password: str) -> bytes:
         password (str): password to be hashed
     """
     b = password.encode()
-    hashed = hashpw(b, bcrypt.gensalt())
+    hashed = hashpw(b, bcrypt.gensalt(get_rounds()))
     return hashed
 
 
-def is_valid(hashed_password: bytes, password: str) -> bool:
+def is_valid(hashed_password: bytes, password: str,
+             on_rehash: Callable[[bytes], None] = None) -> bool:
     """
     Check whether a password is valid
     Args:
         hashed_password (bytes): hashed password
         password (str): password in string
+        on_rehash (callable): receives a new hash of a valid password
+            stored with an outdated cost, computed on a background thread
     Return:
         bool
     """
-    return bcrypt.checkpw(password.encode(), hashed_password)
+    valid = bcrypt.checkpw(password.encode(), hashed_password)
+    if valid and on_rehash is not None and needs_rehash(hashed_password):
+        _rehasher.submit(lambda: on_rehash(hash_password(password))) \
+            .add_done_callback(_report_rehash)
+    return valid
+
+
+def _report_rehash(future: Future):
+    """ Logs the error of a failed background rehash """
+    error = future.exception()
+    if error is not None:
+        logging.getLogger(__name__).error(
+            "password rehash failed", exc_info=error)
+
+
+def _executor(workers: int = None, processes: bool = False) -> Executor:
+    """ Returns the pool the batch functions fan the work out to """
+    if processes:
+        # calibrate once here so forked workers inherit the cost
+        get_rounds()
+        return ProcessPoolExecutor(max_workers=workers)
+    # bcrypt releases the GIL while hashing, threads run in parallel
+    return ThreadPoolExecutor(max_workers=workers)
+
+
+def hash_password_many(passwords: Iterable[str], workers: int = None,
+                       processes: bool = False) -> List[bytes]:
+    """
+    Hashes many passwords concurrently
+    Args:
+        passwords (iterable): passwords to be hashed
+        workers (int): size of the pool, the executor default if None
+        processes (bool): use a process pool instead of threads
+    Return:
+        hashed passwords, in the order of passwords
+    """
+    with _executor(workers, processes) as executor:
+        return list(executor.map(hash_password, passwords))
+
+
+def is_valid_many(pairs: Iterable[Tuple[bytes, str]], workers: int = None,
+                  processes: bool = False) -> List[bool]:
+    """
+    Checks many passwords concurrently
+    Args:
+        pairs (iterable): (hashed password, password) tuples
+        workers (int): size of the pool, the executor default if None
+        processes (bool): use a process pool instead of threads
+    Return:
+        validity of every pair, in the order of pairs
+    """
+    pairs = list(pairs)
+    with _executor(workers, processes) as executor:
+        return list(executor.map(is_valid, [h for h, _ in pairs],
+                                 [p for _, p in pairs]))
+
+
+async def hash_password_many_async(passwords: Iterable[str],
+                                   workers: int = None) -> List[bytes]:
+    """
+    Hashes many passwords on a thread pool without blocking the loop
+    Return:
+        hashed passwords, in the order of passwords
+    """
+    return await _map_async(hash_password, ((p,) for p in passwords),
+                            workers)
+
+
+async def is_valid_many_async(pairs: Iterable[Tuple[bytes, str]],
+                              workers: int = None) -> List[bool]:
+    """
+    Checks many passwords on a thread pool without blocking the loop
+    Return:
+        validity of every pair, in the order of pairs
+    """
+    return await _map_async(is_valid, pairs, workers)
+
+
+async def _map_async(func: Callable, args: Iterable[tuple],
+                     workers: int = None) -> List[Any]:
+    """
+    Runs func on every tuple of args on a thread pool of its own,
+    results in the order of args
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        return list(await asyncio.gather(*(
+            loop.run_in_executor(executor, func, *a) for a in args)))
+    finally:
+        # cancelled, the loop does not wait for the queued hashes: they
+        # are dropped, the running ones end on their threads
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+if "BCRYPT_BUDGET_MS" in environ:
+    # at startup rather than in the first request
+    calibrate_rounds()
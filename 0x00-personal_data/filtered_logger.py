@@ -2,40 +2,201 @@
 """
 Module for handling Personal Data tasks 0 to 4
 """
+import argparse
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import copy
+from functools import lru_cache
+import hashlib
+import hmac
+import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import mysql.connector
-from os import environ
+from os import environ, getpid, makedirs, path
+import queue
 import re
-from typing import List
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from typing import (Any, Callable, Iterable, Iterator, List, Mapping,
+                    TextIO, Tuple)
 
 
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
+SQL_SEED = path.join(path.dirname(path.abspath(__file__)), "main.sql")
+MYSQL_ONLY = ("CREATE DATABASE", "CREATE USER", "GRANT", "USE ")
+_POOL = None
 
 
 def filter_datum(fields: List[str], redaction: str,
                  message: str, separator: str) -> str:
     """ Returns a log message obfuscated """
-    for f in fields:
-        message = re.sub(f'{f}=.*?{separator}',
-                         f'{f}={redaction}{separator}', message)
-    return message
+    if not fields:
+        return message
+    return _redaction_engine(tuple(fields), redaction, separator)(message)
 
 
-def get_logger() -> logging.Logger:
-    """ Returns a Logger Object """
+@lru_cache(maxsize=128)
+def _redaction_engine(fields: Tuple[str, ...], redaction: str,
+                      separator: str) -> Callable[[str], str]:
+    """
+    Compiles every field plus the separator into one alternation so a
+    message is rewritten in a single pass
+    Args:
+        fields (tuple): field names, used as regex like filter_datum does
+        redaction (str): replacement for the field values
+        separator (str): separator ending every field value
+    """
+    if not all(re.escape(f) == f for f in fields + (separator,)):
+        # regex fields or separator: keep the field by field semantics
+        subs = [(re.compile(f'{f}=.*?{separator}'),
+                 f'{f}={redaction}{separator}') for f in fields]
+
+        def redact(message: str) -> str:
+            """ Rewrites message one field at a time """
+            for pattern, template in subs:
+                message = pattern.sub(template, message)
+            return message
+        return redact
+
+    # expand the templates once, the same way re.sub expands them
+    replacements = {f: re.sub('', f'{f}={redaction}{separator}', '')
+                    for f in fields}
+    # a lazy .*? stops at the first separator of the line, which a
+    # negated class finds without backtracking
+    value = f'[^{separator}\\n]*' if len(separator) == 1 else '.*?'
+    pattern = re.compile('({})={}{}'.format('|'.join(fields), value,
+                                            separator))
+
+    def redact(message: str) -> str:
+        """ Rewrites message in one scan """
+        return pattern.sub(lambda m: replacements[m[1]], message)
+
+    return redact
+
+
+def pseudonymize_datum(fields: List[str], token: Callable[[str], str],
+                       message: str, separator: str) -> str:
+    """
+    Returns a log message with the value of every field replaced by its
+    token, in one scan
+    Args:
+        fields (list): fields to pseudonymize
+        token (callable): returns the token of a value
+        message (str): log message
+        separator (str): separator ending every field value
+    """
+    if not fields:
+        return message
+    return _value_pattern(tuple(fields), separator).sub(
+        lambda m: '{}={}{}'.format(m['field'], token(m['value']), m['sep']),
+        message)
+
+
+@lru_cache(maxsize=128)
+def _value_pattern(fields: Tuple[str, ...], separator: str) -> re.Pattern:
+    """ Compiles the fields in one pattern capturing field and value """
+    return re.compile('(?P<field>{})=(?P<value>.*?)(?P<sep>{})'.format(
+        '|'.join(fields), separator))
+
+
+@lru_cache(maxsize=32)
+def _detector_pattern(detectors: Tuple[str, ...]) -> re.Pattern:
+    """ Combines the detectors in one pattern so text is scanned once """
+    # a single lookbehind skips the positions inside words, where no
+    # detector can start, instead of trying every alternative there
+    return re.compile(r'(?<![\w.+-])(?:{})'.format('|'.join(
+        f'(?:{RedactingFormatter.DETECTORS[d]})' for d in detectors)))
+
+
+def get_logger(async_mode: bool = False, queue_size: int = 10000,
+               overflow: str = "block", output: str = "kv",
+               detectors: Iterable[str] = (),
+               pseudonymize: bool = False,
+               sampling: bool = False) -> logging.Logger:
+    """
+    Returns a Logger Object, configured once however often it is called
+    Args:
+        async_mode (bool): redact and write records on a listener thread
+        queue_size (int): bound of the queue used in async mode
+        overflow (str): "block", "drop_oldest" or "drop_newest" when the
+            queue is full
+        output (str): "kv" or "json" rendering of mapping messages
+        detectors (iterable): RedactingFormatter.DETECTORS to enable
+        pseudonymize (bool): replace values by tokens keyed with
+            PERSONAL_DATA_PSEUDONYM_KEY instead of redacting them
+        sampling (bool): put a SamplingFilter with its default limits on
+            the logger, dropping records before they are redacted
+    """
     logger = logging.getLogger("user_data")
+    if logger.handlers:
+        return logger
+    key = None
+    if pseudonymize:
+        key = environ.get("PERSONAL_DATA_PSEUDONYM_KEY")
+        if not key:
+            raise ValueError("PERSONAL_DATA_PSEUDONYM_KEY is not set")
+        key = key.encode()
     logger.setLevel(logging.INFO)
     logger.propagate = False
+    if sampling:
+        sampler = SamplingFilter(logger)
+        logger.addFilter(sampler)
+        # before logging.shutdown closes the handlers, registered first
+        atexit.register(sampler.flush)
 
     stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(RedactingFormatter(list(PII_FIELDS)))
-    logger.addHandler(stream_handler)
+    stream_handler.setFormatter(RedactingFormatter(list(PII_FIELDS),
+                                                   output, detectors, key))
+    if async_mode:
+        logger.addHandler(AsyncRedactingHandler(stream_handler, queue_size,
+                                                overflow))
+    else:
+        logger.addHandler(stream_handler)
 
     return logger
 
 
 def get_db() -> mysql.connector.connection.MySQLConnection:
-    """ Returns a connector to a MySQL database """
+    """ Returns a connector to a MySQL database, or to its SQLite stand-in
+        when PERSONAL_DATA_DB_ENGINE is sqlite. The connection comes from
+        a pool when PERSONAL_DATA_DB_POOL_SIZE is set, closing it gives
+        it back """
+    pool_size = int(environ.get("PERSONAL_DATA_DB_POOL_SIZE", 0))
+    if pool_size > 0:
+        return get_pool(pool_size).acquire()
+    return connect_db()
+
+
+@contextmanager
+def db_connection() -> Iterator[mysql.connector.connection.MySQLConnection]:
+    """ Yields a connection from get_db and closes it, which returns a
+        pooled connection to its pool """
+    db = get_db()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_pool(size: int = 5) -> 'ConnectionPool':
+    """ Returns the pool of the current process, created on first use """
+    global _POOL
+    # a forked worker must not share the sockets of its parent
+    if _POOL is None or _POOL.pid != getpid():
+        _POOL = ConnectionPool(connect_db, size)
+    return _POOL
+
+
+def connect_db() -> mysql.connector.connection.MySQLConnection:
+    """ Opens a new connection to the configured database """
+    if environ.get("PERSONAL_DATA_DB_ENGINE") == "sqlite":
+        return get_sqlite_db()
     username = environ.get("PERSONAL_DATA_DB_USERNAME", "root")
     password = environ.get("PERSONAL_DATA_DB_PASSWORD", "")
     host = environ.get("PERSONAL_DATA_DB_HOST", "localhost")
@@ -48,6 +209,156 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
     return cnx
 
 
+def get_sqlite_db(db_path: str = None) -> sqlite3.Connection:
+    """
+    Returns a connection to a SQLite stand-in of the MySQL database,
+    seeded from main.sql the first time
+    Args:
+        db_path (str): database file, PERSONAL_DATA_SQLITE_PATH by default
+    """
+    if db_path is None:
+        db_path = environ.get("PERSONAL_DATA_SQLITE_PATH",
+                              "personal_data.sqlite3")
+    # pooled connections are handed from thread to thread
+    cnx = sqlite3.connect(db_path, check_same_thread=False)
+    if cnx.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                   "AND name = 'users';").fetchone() is None:
+        seed_sqlite_db(cnx, SQL_SEED)
+    return cnx
+
+
+def seed_sqlite_db(cnx: sqlite3.Connection, sql_path: str):
+    """ Runs the statements of a MySQL script that SQLite understands """
+    statement = ''
+    with open(sql_path) as f:
+        for line in f:
+            if line.lstrip().startswith('--'):
+                continue
+            statement += line
+            if not sqlite3.complete_statement(statement):
+                continue
+            if not statement.strip().upper().startswith(MYSQL_ONLY):
+                cnx.execute(statement)
+            statement = ''
+    cnx.commit()
+
+
+class PooledConnection:
+    """ Connection checked out of a ConnectionPool, close returns it
+        """
+
+    def __init__(self, pool: 'ConnectionPool', raw):
+        """ Constructor Method """
+        self._pool = pool
+        self.raw = raw
+
+    def __getattr__(self, name: str):
+        """ Delegates everything else to the underlying connection """
+        return getattr(self.raw, name)
+
+    def __enter__(self) -> 'PooledConnection':
+        """ Context manager entry """
+        return self
+
+    def __exit__(self, *exc_info):
+        """ Returns the connection to the pool """
+        self.close()
+
+    def close(self):
+        """ Returns the connection to the pool instead of closing it """
+        if self.raw is not None:
+            self._pool.release(self.raw)
+            self.raw = None
+
+
+class ConnectionPool:
+    """ Bounded pool of database connections validated on checkout
+        """
+
+    def __init__(self, connect: Callable, size: int = 5,
+                 timeout: float = 30.0):
+        """
+        Constructor Method
+        Args:
+            connect (callable): opens a new connection
+            size (int): maximum number of connections checked out at once
+            timeout (float): seconds acquire waits for a free connection
+        """
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.pid = getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self) -> PooledConnection:
+        """ Checks out an idle connection that still answers, or opens
+            a new one """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError("no database connection available")
+        try:
+            while True:
+                try:
+                    cnx = self._idle.get_nowait()
+                except queue.Empty:
+                    cnx = self._connect()
+                    break
+                if self._ping(cnx):
+                    break
+                self._discard(cnx)
+        except BaseException:
+            self._slots.release()
+            raise
+        return PooledConnection(self, cnx)
+
+    def release(self, cnx):
+        """ Rolls back what was left open and puts cnx back in the pool """
+        try:
+            cnx.rollback()
+            self._idle.put(cnx)
+        except Exception:
+            self._discard(cnx)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[PooledConnection]:
+        """ Yields a connection and returns it to the pool afterwards """
+        cnx = self.acquire()
+        try:
+            yield cnx
+        finally:
+            cnx.close()
+
+    def close(self):
+        """ Closes the idle connections """
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    @staticmethod
+    def _ping(cnx) -> bool:
+        """ Pre-ping: tells whether cnx still answers a query """
+        try:
+            cursor = cnx.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _discard(cnx):
+        """ Closes a connection, ignoring errors of a dead one """
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+
 class RedactingFormatter(logging.Formatter):
     """ Redacting Formatter class
         """
@@ -55,24 +366,509 @@ class RedactingFormatter(logging.Formatter):
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
+    OUTPUTS = ("kv", "json")
+    TOKEN_LENGTH = 12
+    # detectors match from the start of a token, see _detector_pattern
+    DETECTORS = {
+        "email": r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+",
+        "ssn": r"\d{3}-\d{2}-\d{4}\b",
+        "phone": r"(?:\+1[ .-]?)?(?:\(\d{3}\) ?|\d{3}[ .-])\d{3}[ .-]\d{4}\b",
+        "ipv4": r"(?:(?:25[0-5]|2[0-4]\d|1?\d?\d)\.){3}"
+                r"(?:25[0-5]|2[0-4]\d|1?\d?\d)\b",
+    }
 
-    def __init__(self, fields: List[str]):
-        """ Constructor Method """
+    def __init__(self, fields: List[str], output: str = "kv",
+                 detectors: Iterable[str] = (), pseudonym_key: bytes = None,
+                 cache_size: int = 4096):
+        """
+        Constructor Method
+        Args:
+            fields (list): fields to redact
+            output (str): rendering of mapping messages, "kv" for
+                "field=value;" pairs or "json" for JSON lines
+            detectors (iterable): names of DETECTORS also redacting PII
+                found by content in messages and exceptions
+            pseudonym_key (bytes): if set, values are replaced by their
+                HMAC token under this key instead of REDACTION
+            cache_size (int): number of tokens kept in the LRU cache
+        """
+        if output not in self.OUTPUTS:
+            raise ValueError("output must be one of {}".format(
+                ", ".join(self.OUTPUTS)))
+        detectors = tuple(detectors)
+        for name in detectors:
+            if name not in self.DETECTORS:
+                raise ValueError("unknown detector: {}".format(name))
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.output = output
+        self._field_set = frozenset(fields)
+        self._detector = _detector_pattern(detectors) if detectors else None
+        self._key = pseudonym_key
+        self._pseudonym = None
+        if pseudonym_key is not None:
+            # logs repeat the same users, most values skip the HMAC
+            self._pseudonym = lru_cache(maxsize=cache_size)(self._hmac_token)
 
     def format(self, record: logging.LogRecord) -> str:
-        """ Filters values in incoming log records using filter_datum """
-        record.msg = filter_datum(self.fields, self.REDACTION,
-                                  record.getMessage(), self.SEPARATOR)
+        """ Filters values in incoming log records using filter_datum, or
+            by field lookup when the message is a mapping """
+        if isinstance(record.msg, Mapping):
+            if self.output == "json":
+                return self.format_json(record)
+            record.msg = self.redact_items(record.msg.items())
+        elif self._pseudonym is not None:
+            record.msg = pseudonymize_datum(self.fields, self._pseudonym,
+                                            record.getMessage(),
+                                            self.SEPARATOR)
+        else:
+            record.msg = filter_datum(self.fields, self.REDACTION,
+                                      record.getMessage(), self.SEPARATOR)
+        record.msg = self.detect(record.msg)
+        # the arguments are merged in record.msg already
+        record.args = None
         return super(RedactingFormatter, self).format(record)
 
+    def detect(self, text: str) -> str:
+        """ Redacts the PII found by the enabled detectors in one scan """
+        if self._detector is None:
+            return text
+        if self._pseudonym is not None:
+            return self._detector.sub(lambda m: self._pseudonym(m[0]), text)
+        return self._detector.sub(self.REDACTION, text)
+
+    def replacement(self, value: Any) -> str:
+        """ Returns what replaces a redacted value """
+        if self._pseudonym is None:
+            return self.REDACTION
+        return self._pseudonym(str(value))
+
+    def _hmac_token(self, value: str) -> str:
+        """ Keyed token of a value, the same for every occurrence """
+        return hmac.new(self._key, value.encode(), hashlib.sha256) \
+            .hexdigest()[:self.TOKEN_LENGTH]
+
+    @property
+    def token_cache_stats(self) -> dict:
+        """ Hits, misses, size and hit rate of the token cache """
+        if self._pseudonym is None:
+            return {}
+        info = self._pseudonym.cache_info()
+        lookups = info.hits + info.misses
+        return {"hits": info.hits, "misses": info.misses,
+                "size": info.currsize,
+                "hit_rate": info.hits / lookups if lookups else 0.0}
+
+    def formatException(self, ei) -> str:
+        """ Formats an exception with its PII redacted """
+        return self.detect(
+            super(RedactingFormatter, self).formatException(ei))
+
+    def formatStack(self, stack_info: str) -> str:
+        """ Formats a stack with its PII redacted """
+        return self.detect(
+            super(RedactingFormatter, self).formatStack(stack_info))
+
+    def redact_items(self, items: Iterable[Tuple[str, Any]]) -> str:
+        """ Renders (field, value) pairs as "field=value;" with the
+            values of the redacted fields replaced """
+        fields, sep = self._field_set, self.SEPARATOR
+        if self._pseudonym is not None:
+            token = self._pseudonym
+            return ' '.join(f'{k}={token(str(v)) if k in fields else v}{sep}'
+                            for k, v in items)
+        redaction = self.REDACTION
+        return ' '.join(f'{k}={redaction if k in fields else v}{sep}'
+                        for k, v in items)
+
+    def format_json(self, record: logging.LogRecord) -> str:
+        """ Renders a mapping message as one JSON line """
+        fields = self._field_set
+        line = {"name": record.name, "level": record.levelname,
+                "time": self.formatTime(record, self.datefmt),
+                "message": {k: self.replacement(v) if k in fields
+                            else self.detect(v) if isinstance(v, str) else v
+                            for k, v in record.msg.items()}}
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+        return json.dumps(line, default=str)
+
 
-def main():
+class SamplingFilter(logging.Filter):
+    """ Rate limits records with a token bucket per level and collapses
+        repeated messages, on the logger so that suppressed records are
+        dropped before any handler redacts them
+        """
+
+    def __init__(self, logger: logging.Logger, rate: float = 100.0,
+                 burst: int = 200, window: float = 1.0,
+                 levels: Mapping[int, Tuple[float, int]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Constructor Method
+        Args:
+            logger (Logger): logger the "repeated N times" summaries are
+                handled by
+            rate (float): records per second refilling a level bucket
+            burst (int): size of a level bucket
+            window (float): seconds during which the same message
+                repeated is collapsed
+            levels (mapping): (rate, burst) overriding the defaults for
+                some levels
+            clock (callable): returns the current time in seconds
+        """
+        super(SamplingFilter, self).__init__()
+        self.logger = logger
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.levels = dict(levels or {})
+        self.clock = clock
+        self.rate_limited = 0
+        self.deduplicated = 0
+        self._buckets = {}
+        self._last = None
+        self._last_start = 0.0
+        self._repeats = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def suppressed(self) -> int:
+        """ Number of records dropped so far """
+        return self.rate_limited + self.deduplicated
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """ Tells whether record goes on to the handlers """
+        if getattr(record, "sampling_summary", False):
+            return True
+        key = (record.levelno, record.getMessage())
+        with self._lock:
+            now = self.clock()
+            if key == self._last and now - self._last_start < self.window:
+                self._repeats += 1
+                self.deduplicated += 1
+                if self._timer is None:
+                    # the summary goes out when the window ends, even
+                    # if no record follows
+                    self._schedule(self._last_start + self.window - now)
+                return False
+            summary = self._take_summary()
+            self._last, self._last_start = key, now
+            allowed = self._take_token(record.levelno, now)
+            if not allowed:
+                self.rate_limited += 1
+        if summary is not None:
+            self.logger.handle(summary)
+        return allowed
+
+    def _schedule(self, delay: float):
+        """ Starts the timer of _expire, under the lock """
+        self._timer = threading.Timer(max(delay, 0.0), self._expire)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self):
+        """ Emits the summary of the repeats once their window ended """
+        with self._lock:
+            self._timer = None
+            summary = None
+            if self._repeats:
+                remaining = self._last_start + self.window - self.clock()
+                if remaining > 0:
+                    self._schedule(remaining)
+                else:
+                    summary = self._take_summary()
+        if summary is not None:
+            self.logger.handle(summary)
+
+    def flush(self):
+        """ Emits the summary of the repeats not reported yet """
+        with self._lock:
+            summary = self._take_summary()
+            self._last = None
+        if summary is not None:
+            self.logger.handle(summary)
+
+    def _take_summary(self) -> logging.LogRecord:
+        """ Returns the summary of the pending repeats, if any """
+        if not self._repeats:
+            return None
+        summary = self.logger.makeRecord(
+            self.logger.name, self._last[0], "(sampling)", 0,
+            "last message repeated %d times", (self._repeats,), None)
+        summary.sampling_summary = True
+        self._repeats = 0
+        return summary
+
+    def _take_token(self, level: int, now: float) -> bool:
+        """ Takes a token from the bucket of level if one is left """
+        rate, burst = self.levels.get(level, (self.rate, self.burst))
+        tokens, last = self._buckets.get(level, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        allowed = tokens >= 1
+        self._buckets[level] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+
+class _DrainingListener(QueueListener):
+    """ QueueListener whose stop waits for room in a full queue """
+
+    def enqueue_sentinel(self):
+        """ Blocks until the sentinel fits so no record is lost """
+        self.queue.put(self._sentinel)
+
+
+class AsyncRedactingHandler(QueueHandler):
+    """ Pushes raw records on a bounded queue, a listener thread redacts
+        and writes them with the wrapped handler
+        """
+
+    OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, handler: logging.Handler, queue_size: int = 10000,
+                 overflow: str = "block"):
+        """ Constructor Method """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of {}".format(
+                ", ".join(self.OVERFLOW_POLICIES)))
+        super(AsyncRedactingHandler, self).__init__(
+            queue.Queue(maxsize=queue_size))
+        self.overflow = overflow
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self.listener = _DrainingListener(self.queue, handler,
+                                          respect_handler_level=True)
+        self.listener.start()
+
+    @property
+    def depth(self) -> int:
+        """ Number of records waiting for the listener """
+        return self.queue.qsize()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """ Merges the arguments but leaves formatting to the listener """
+        record = copy.copy(record)
+        if isinstance(record.msg, Mapping):
+            record.msg = dict(record.msg)
+        else:
+            record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        """ Queues record following the overflow policy """
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                if self.overflow == "drop_newest":
+                    self._count_drop()
+                    return
+            try:
+                self.queue.get_nowait()
+                self._count_drop()
+            except queue.Empty:
+                pass
+
+    def _count_drop(self):
+        """ Counts one dropped record """
+        with self._lock:
+            self.dropped += 1
+
+    def close(self):
+        """ Flushes the queued records before closing """
+        if self.listener._thread is not None:
+            self.listener.stop()
+        super(AsyncRedactingHandler, self).close()
+
+
+def export_users(db, out: TextIO, batch_size: int = 1000) -> int:
+    """
+    Streams the users table to out as redacted log lines
+    Args:
+        db: database connection returned by get_db
+        out (TextIO): output target, written once per batch
+        batch_size (int): number of rows fetched and written at a time
+    Return:
+        number of exported rows
+    """
+    cursor = _stream_cursor(db)
+    cursor.execute("SELECT * FROM users;")
+    count = _write_batches(cursor, out, batch_size)
+    cursor.close()
+    return count
+
+
+def _stream_cursor(db):
+    """ Returns a cursor leaving the rows on the server until fetched """
+    if _is_sqlite(db):
+        return db.cursor()
+    return db.cursor(buffered=False)
+
+
+def _is_sqlite(db) -> bool:
+    """ Tells whether db, pooled or not, is a SQLite connection """
+    return isinstance(getattr(db, "raw", db), sqlite3.Connection)
+
+
+def _write_batches(cursor, out: TextIO, batch_size: int) -> int:
+    """ Writes the rows of an executed cursor, one write per batch """
+    formatter = RedactingFormatter(list(PII_FIELDS))
+    field_names = [i[0] for i in cursor.description]
+
+    count = 0
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        prefix = formatter.format(logging.LogRecord(
+            "user_data", logging.INFO, None, None, "", None, None))
+        out.write(''.join(
+            prefix + formatter.redact_items(zip(field_names, row)) + '\n'
+            for row in rows))
+        count += len(rows)
+        rows = cursor.fetchmany(batch_size)
+    return count
+
+
+def export_users_parallel(out: TextIO = None, output_dir: str = None,
+                          workers: int = 4, partitions: int = None,
+                          batch_size: int = 1000, key: str = None) -> int:
+    """
+    Exports the users table from a pool of worker processes, each one
+    with its own get_db connection, on ranges of the table
+    Args:
+        out (TextIO): receives the partitions merged in table order
+        output_dir (str): if set, every partition is written to its own
+            users.<n>.log file there instead of out
+        workers (int): number of worker processes
+        partitions (int): number of ranges, 4 per worker by default
+        batch_size (int): rows fetched and written at a time by a worker
+        key (str): integer column split in value ranges, rowid on SQLite;
+            without one the table is split in LIMIT/OFFSET ranges
+    Return:
+        number of exported rows
+    """
+    db = get_db()
+    if key is None and _is_sqlite(db):
+        key = "rowid"
+    cursor = db.cursor()
+    if key is None:
+        cursor.execute("SELECT 0, COUNT(*) - 1 FROM users;")
+    else:
+        cursor.execute("SELECT MIN({0}), MAX({0}) FROM users;".format(key))
+    low, high = cursor.fetchone()
+    cursor.close()
+    db.close()
+    if low is None or high < low:
+        return 0
+
+    partitions = partitions or workers * 4
+    size = -(-(high - low + 1) // partitions)
+    if output_dir is not None:
+        makedirs(output_dir, exist_ok=True)
+        return _export_ranges(low, high, size, key, batch_size, workers,
+                              output_dir)
+    # merged: the workers write part files, copied in table order once
+    # all are done, so the parent never holds a partition in memory
+    with tempfile.TemporaryDirectory() as directory:
+        count = _export_ranges(low, high, size, key, batch_size, workers,
+                               directory)
+        for n in range(len(range(low, high + 1, size))):
+            with open(path.join(directory,
+                                "users.{:04d}.log".format(n))) as part:
+                shutil.copyfileobj(part, out)
+    return count
+
+
+def _export_ranges(low: int, high: int, size: int, key: str,
+                   batch_size: int, workers: int, directory: str) -> int:
+    """
+    Exports the ranges of size rows from low to high, each one to its
+    users.<n>.log file in directory
+    Return:
+        number of exported rows
+    """
+    ranges = [(start, size, key, batch_size, path.join(
+        directory, "users.{:04d}.log".format(n)))
+        for n, start in enumerate(range(low, high + 1, size))]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(_export_partition, ranges))
+
+
+def _export_partition(task: Tuple[int, int, str, int, str]) -> int:
+    """
+    Exports one range of the users table to its file in a worker
+    Return:
+        number of rows
+    """
+    start, size, key, batch_size, file_path = task
+    db = get_db()
+    cursor = _stream_cursor(db)
+    if key is None:
+        cursor.execute("SELECT * FROM users LIMIT 0;")
+        cursor.fetchall()
+        # ordering on every column makes the ranges deterministic on a
+        # table without primary key
+        order = ', '.join(str(i + 1)
+                          for i in range(len(cursor.description)))
+        cursor.execute("SELECT * FROM users ORDER BY {} LIMIT {} OFFSET {};"
+                       .format(order, int(size), int(start)))
+    else:
+        cursor.execute("SELECT * FROM users WHERE {0} >= {1} AND {0} < {2} "
+                       "ORDER BY {0};".format(key, int(start),
+                                              int(start + size)))
+    with open(file_path, "w") as f:
+        rows = _write_batches(cursor, f, batch_size)
+    cursor.close()
+    db.close()
+    return rows
+
+
+def main(argv: List[str] = None):
     """
     Obtain a database connection using get_db and retrieves all rows
     in the users table and display each row under a filtered format
     """
+    parser = argparse.ArgumentParser(description="Exports the users table "
+                                     "with its PII fields redacted")
+    parser.add_argument("--stream", action="store_true",
+                        help="write batches of lines instead of logging "
+                        "every row")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="rows fetched per batch in stream mode")
+    parser.add_argument("--output", default="-",
+                        help="file written in stream mode, - for stdout")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes exporting ranges of the "
+                        "table in stream mode")
+    parser.add_argument("--output-dir",
+                        help="with --workers, write one file per range "
+                        "in this directory")
+    args = parser.parse_args(argv)
+
+    if args.stream:
+        start = time.perf_counter()
+        out = sys.stdout if args.output == "-" else open(args.output, "w")
+        if args.workers > 1 or args.output_dir:
+            count = export_users_parallel(out, args.output_dir,
+                                          args.workers,
+                                          batch_size=args.batch_size)
+        else:
+            db = get_db()
+            count = export_users(db, out, args.batch_size)
+            db.close()
+        if out is not sys.stdout:
+            out.close()
+        elapsed = time.perf_counter() - start
+        print("{} rows in {:.2f}s ({:.0f} rows/s)".format(
+            count, elapsed, count / elapsed if elapsed else 0),
+            file=sys.stderr)
+        return
+
     db = get_db()
     cursor = db.cursor()
     cursor.execute("SELECT * FROM users;")
@@ -81,8 +877,7 @@ def main():
     logger = get_logger()
 
     for row in cursor:
-        str_row = ''.join(f'{f}={str(r)}; ' for r, f in zip(row, field_names))
-        logger.info(str_row.strip())
+        logger.info(dict(zip(field_names, row)))
 
     cursor.close()
     db.close()
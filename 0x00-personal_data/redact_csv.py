@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Redacts the PII columns of a CSV dump shaped like user_data.csv
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+from typing import IO, Iterator, List, Sequence, Tuple
+
+filtered_logger = __import__('filtered_logger')
+
+
+def redact_rows(rows: Iterator[List[str]], columns: Sequence[int],
+                redaction: str) -> Iterator[List[str]]:
+    """
+    Replaces the given columns of every row
+    Args:
+        rows (iterator): parsed CSV rows
+        columns (sequence): indexes of the columns to redact
+        redaction (str): replacement for the redacted values
+    """
+    for row in rows:
+        for i in columns:
+            if i < len(row):
+                row[i] = redaction
+        yield row
+
+
+def column_name(name: str) -> str:
+    """ Normalised column name: no byte order mark, spaces or case """
+    return name.lstrip('\ufeff').strip().lower()
+
+
+def pii_columns(header: List[str], fields: Sequence[str]) -> List[int]:
+    """
+    Returns the indexes of the header columns listed in fields
+    Raises:
+        ValueError: a field names no column of the header
+    """
+    fields = {column_name(field) for field in fields} - {''}
+    names = [column_name(name) for name in header]
+    missing = sorted(fields.difference(names))
+    if missing:
+        raise ValueError("columns not in the header: {}"
+                         .format(", ".join(missing)))
+    return [i for i, name in enumerate(names) if name in fields]
+
+
+def redact_stream(src: IO[str], dst: IO[str], fields: Sequence[str],
+                  redaction: str = filtered_logger.RedactingFormatter
+                  .REDACTION, batch_size: int = 1000) -> int:
+    """
+    Streams a CSV file with a header line from src to dst, redacted
+    Return:
+        number of data rows
+    """
+    reader = csv.reader(src)
+    writer = csv.writer(dst, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    header = next(reader, None)
+    if header is None:
+        return 0
+    columns = pii_columns(header, fields)
+    writer.writerow(header)
+    return _write_rows(redact_rows(reader, columns, redaction), writer,
+                       batch_size)
+
+
+def _write_rows(rows: Iterator[List[str]], writer, batch_size: int) -> int:
+    """ Writes rows by batches so memory stays bounded """
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            writer.writerows(batch)
+            count += len(batch)
+            batch = []
+    writer.writerows(batch)
+    return count + len(batch)
+
+
+def byte_ranges(file_path: str, parts: int) -> List[Tuple[int, int]]:
+    """
+    Splits the data lines of a file in ranges of about the same size,
+    every range starting at the beginning of a line
+    """
+    with open(file_path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = mm.find(b'\n') + 1 or size
+            bounds = [start]
+            for n in range(1, parts):
+                cut = mm.find(b'\n', max(start + (size - start) * n // parts,
+                                         bounds[-1])) + 1 or size
+                bounds.append(cut)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if a < b]
+
+
+def _redact_range(task: Tuple[str, int, int, List[int], str, str]) -> int:
+    """ Redacts one byte range of the source file into a part file """
+    src_path, start, end, columns, redaction, part_path = task
+    with open(src_path, 'rb') as src, \
+            open(part_path, 'w', newline='') as dst:
+        src.seek(start)
+
+        def lines() -> Iterator[str]:
+            """ Decoded lines of the range """
+            position = start
+            for line in src:
+                yield line.decode()
+                position += len(line)
+                if position >= end:
+                    return
+
+        writer = csv.writer(dst, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        return _write_rows(redact_rows(csv.reader(lines()), columns,
+                                       redaction), writer, 1000)
+
+
+def redact_file(src_path: str, dst: IO[str], fields: Sequence[str],
+                workers: int = 1,
+                redaction: str = filtered_logger.RedactingFormatter
+                .REDACTION) -> int:
+    """
+    Redacts a CSV file into dst, splitting the work by byte range over
+    worker processes when workers is more than 1. Parallel mode expects
+    one record per line: quoted values must not hold line breaks.
+    Return:
+        number of data rows
+    Raises:
+        ValueError: a field names no column of the header, nothing is
+        written then
+    """
+    if workers <= 1:
+        with open(src_path, newline='', encoding='utf-8-sig') as src:
+            return redact_stream(src, dst, fields, redaction)
+
+    # the byte ranges start after the header, past the byte order mark
+    with open(src_path, newline='', encoding='utf-8-sig') as src:
+        header = next(csv.reader(src), None)
+    if header is None:
+        return 0
+    columns = pii_columns(header, fields)
+    csv.writer(dst, quoting=csv.QUOTE_ALL,
+               lineterminator='\n').writerow(header)
+
+    with tempfile.TemporaryDirectory() as directory:
+        tasks = [(src_path, start, end, columns, redaction,
+                  os.path.join(directory, "part.{:04d}".format(n)))
+                 for n, (start, end) in enumerate(byte_ranges(src_path,
+                                                              workers))]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            count = sum(executor.map(_redact_range, tasks))
+        for task in tasks:
+            with open(task[-1], newline='') as part:
+                shutil.copyfileobj(part, dst)
+    return count
+
+
+def main(argv: List[str] = None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description="Redacts the PII columns "
+                                     "of a CSV file with a header line")
+    parser.add_argument("source", help="CSV file to redact")
+    parser.add_argument("--output", default="-",
+                        help="redacted CSV file, - for stdout")
+    parser.add_argument("--fields", default=",".join(
+        filtered_logger.PII_FIELDS), help="comma separated columns")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes splitting the file by byte range")
+    args = parser.parse_args(argv)
+
+    fields = args.fields.split(",")
+    try:
+        if args.output == "-":
+            redact_file(args.source, sys.stdout, fields, args.workers)
+        else:
+            with open(args.output, "w", newline='') as dst:
+                redact_file(args.source, dst, fields, args.workers)
+    except ValueError as e:
+        # no partially redacted file left behind
+        if args.output != "-":
+            os.remove(args.output)
+        parser.error(str(e))
+
+
+if __name__ == '__main__':
+    main()
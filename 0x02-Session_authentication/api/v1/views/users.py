@@ -2,7 +2,7 @@
 """ Module of Users views
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import Response, abort, jsonify, request
 from models.user import User
 
 
@@ -12,8 +12,17 @@ def view_all_users() -> str:
     Return:
       - list of all User objects JSON represented
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    def generate():
+        """ The list streamed one user at a time, from the cached JSON
+        of every user
+        """
+        separator = b'['
+        for user in User.query():
+            yield separator + user.to_json_bytes()
+            separator = b','
+        yield b'[]\n' if separator == b'[' else b']\n'
+
+    return Response(generate(), mimetype='application/json')
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
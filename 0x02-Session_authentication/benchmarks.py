@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+""" Benchmarks of the models storage
+"""
+from datetime import datetime
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from models import base
+from models.base import DATA, TIMESTAMP_FORMAT
+from models.user import User
+
+
+def create_users(count: int):
+    """ Fill DATA with count users and save them to file
+    """
+    DATA['User'] = {}
+    for i in range(count):
+        user = User(email="user{}@hbtn.io".format(i),
+                    first_name="First{}".format(i % 1000),
+                    last_name="Last{}".format(i % 5000))
+        user.password = "pwd{}".format(i)
+        DATA['User'][user.id] = user
+    User.save_to_file()
+
+
+def legacy_load():
+    """ load_from_file as it was: one cls(**obj_json) per record
+    """
+    import json
+    DATA['User'] = {}
+    with open(".db_User.json", 'r') as f:
+        for obj_id, obj_json in json.load(f).items():
+            DATA['User'][obj_id] = User(**obj_json)
+    User.build_indexes()
+
+
+def bench_load(counts=(10000, 100000, 300000), workers: int = 4):
+    """ Load time against user count, legacy, bulk and parallel bulk
+    """
+    cases = (("legacy", legacy_load),
+             ("bulk", lambda: User.load_from_file(workers=0)),
+             ("bulk {} workers".format(workers),
+              lambda: User.load_from_file(workers=workers)))
+    for count in counts:
+        create_users(count)
+        for name, load in cases:
+            start = time.perf_counter()
+            load()
+            elapsed = time.perf_counter() - start
+            assert User.count() == count
+            print("load {:>8} users {:<18} {:>8.3f}s".format(
+                count, name, elapsed))
+
+
+def bench_threads(threads=(1, 2, 4, 8, 16, 32), users: int = 1000,
+                  ops: int = 20000):
+    """ Throughput of a get/search/save/all mix against thread count,
+    with a write-behind flusher rewriting the file meanwhile
+    """
+    create_users(users)
+    User.load_from_file()
+    ids = list(DATA['User'].keys())
+    previous = base.WRITE_BEHIND
+    base.WRITE_BEHIND = base.WriteBehind(0.01, 1000)
+    for count in threads:
+        errors = []
+
+        def worker(seed: int):
+            rng = random.Random(seed)
+            try:
+                for _ in range(ops // count):
+                    pick = rng.random()
+                    if pick < 0.7:
+                        User.get(rng.choice(ids))
+                    elif pick < 0.85:
+                        User.search({'email': "user{}@hbtn.io".format(
+                            rng.randrange(users))})
+                    elif pick < 0.99:
+                        user = User.get(rng.choice(ids))
+                        user.first_name = "First{}".format(seed)
+                        user.save()
+                    else:
+                        User.all()
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=worker, args=(n,))
+                   for n in range(count)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        base.WRITE_BEHIND.flush()
+        assert not errors, errors[0]
+        print("mix {:>3} threads {:>10.0f} ops/s".format(
+            count, ops / elapsed))
+    User.load_from_file()
+    assert User.count() == users
+    base.WRITE_BEHIND = previous
+
+
+def bench_import(counts=(1000, 50000)):
+    """ Import time of users saved one by one against save_many
+    """
+    for count in counts:
+        for name in ("save", "save_many"):
+            if name == "save" and count > 1000:
+                # one file rewrite per user, quadratic
+                continue
+            DATA['User'] = {}
+            User.save_to_file()
+            users = [User(email="import{}@hbtn.io".format(i))
+                     for i in range(count)]
+            start = time.perf_counter()
+            if name == "save":
+                for user in users:
+                    user.save()
+            else:
+                User.save_many(users)
+            elapsed = time.perf_counter() - start
+            print("import {:>6} users {:<17} {:>8.3f}s".format(
+                count, name, elapsed))
+
+
+def legacy_to_json(obj, for_serialization: bool = False) -> dict:
+    """ to_json as it was: rebuilt and strftime on every call
+    """
+    result = {}
+    for key, value in obj.__dict__.items():
+        if not for_serialization and key[0] == '_':
+            continue
+        if type(value) is datetime:
+            result[key] = value.strftime(TIMESTAMP_FORMAT)
+        else:
+            result[key] = value
+    return result
+
+
+def bench_listing(count: int = 100000):
+    """ GET /api/v1/users body and save_to_file for count users: to_json
+    rebuilt every time against the cached bytes, cold then warm, and
+    the bytes per user the caches keep
+    """
+    import gc
+    import json
+    import tracemalloc
+    create_users(count)
+    User.load_from_file()
+
+    def drop_caches():
+        """ Forget the serializations of all users
+        """
+        for user in DATA['User'].values():
+            object.__setattr__(user, '_cached', None)
+
+    def timed(name: str, func):
+        """ Print the time of one call
+        """
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        print("{:<19} {:>8} users {:>8.3f}s".format(name, count, elapsed))
+
+    def kept(name: str, func):
+        """ Print the bytes per user a cold call leaves in the caches
+        """
+        drop_caches()
+        gc.collect()
+        tracemalloc.start()
+        func()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("{:<19} {:>8} users {:>8.0f} bytes/user kept".format(
+            name, count, size / count))
+
+    def listing() -> bytes:
+        """ Body of GET /api/v1/users from the cached bytes
+        """
+        return b'[' + b','.join(
+            user.to_json_bytes() for user in User.query()) + b']'
+
+    timed("listing legacy", lambda: json.dumps(
+        [legacy_to_json(user) for user in User.all()]).encode())
+    drop_caches()
+    timed("listing cached", listing)
+    timed("listing cached", listing)
+    kept("listing cached", listing)
+    timed("save_to_file legacy", lambda: json.dump(
+        {obj_id: legacy_to_json(obj, True)
+         for obj_id, obj in DATA['User'].items()},
+        open(os.devnull, 'w')))
+    snapshot_cache = base.SNAPSHOT_CACHE
+    for cache in (False, True):
+        # BASE_SNAPSHOT_CACHE off, then on
+        base.SNAPSHOT_CACHE = cache
+        name = "save_to_file cached" if cache else "save_to_file"
+        drop_caches()
+        timed(name, User.save_to_file)
+        timed(name, User.save_to_file)
+        kept(name, User.save_to_file)
+    base.SNAPSHOT_CACHE = snapshot_cache
+
+
+def bench_memory(count: int = 100000):
+    """ Bytes per user held by DATA once loaded, then after a save of
+    all of them, with User and with its compact variant
+    """
+    import gc
+    import tracemalloc
+    from models.compact import compact
+    create_users(count)
+    for name, cls in (("User", User),
+                      ("compact User", compact(
+                          User, interned=('first_name', 'last_name')))):
+        DATA['User'] = {}
+        base.INDEX['User'] = {}
+        gc.collect()
+        tracemalloc.start()
+        cls.load_from_file(workers=0)
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        cls.save_to_file()
+        gc.collect()
+        saved = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        assert cls.count() == count
+        print("memory {:<13} {:>8} users {:>8.0f} bytes/user, {:>8.0f} "
+              "after a save".format(name, count, size / count,
+                                    saved / count))
+
+
+def write_users(count: int):
+    """ Write a .db_User.json of count users straight as text, without
+    building the objects
+    """
+    import json
+    import uuid
+    start = datetime(2020, 1, 1).timestamp()
+    with open(".db_User.json", 'w') as f:
+        f.write("{")
+        for i in range(count):
+            created = datetime.fromtimestamp(start + i * 60).strftime(
+                TIMESTAMP_FORMAT)
+            obj_id = str(uuid.UUID(int=i))
+            f.write("{}{}: {}".format(", " if i else "", json.dumps(obj_id),
+                                      json.dumps({
+                                          "id": obj_id,
+                                          "created_at": created,
+                                          "updated_at": created,
+                                          "email": "user{}@hbtn.io".format(i),
+                                          "_password": None,
+                                          "first_name": "First{}".format(
+                                              i % 1000),
+                                          "last_name": "Last{}".format(
+                                              i % 5000)})))
+        f.write("}")
+
+
+def bench_columnar(count: int = 1000000, repeat: int = 3):
+    """ Unindexed equality search, created_at range count and email
+    eq and in with the file engine and the columnar one, with and
+    without NumPy
+    """
+    from models.engine import columnar_storage
+    from models.engine.columnar_storage import ColumnarStorage
+    from models.engine.file_storage import FileStorage
+    from models.query import Query
+    write_users(count)
+    low = datetime(2020, 3, 1)
+    high = datetime(2020, 6, 1)
+    search = Query(User, {'last_name': "Last42"})
+    in_range = Query(User).where('created_at', 'range', (low, high))
+    # a distinct value per row
+    email = Query(User, {'email': "user42@hbtn.io"})
+    emails = Query(User).where('email', 'in',
+                               ["user42@hbtn.io", "user43@hbtn.io"])
+
+    def timed(func) -> float:
+        """ Best time of repeat calls, in ms
+        """
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000
+
+    numpy = columnar_storage.numpy
+    engines = [("file", FileStorage)]
+    if numpy is not None:
+        engines.append(("columnar numpy", ColumnarStorage))
+    engines.append(("columnar python", ColumnarStorage))
+    for name, engine_cls in engines:
+        columnar_storage.numpy = numpy if name == "columnar numpy" else None
+        engine = engine_cls()
+        start = time.perf_counter()
+        engine.load(User)
+        loaded = time.perf_counter() - start
+        print("engine {:<15} load {:>6.1f} s".format(name, loaded))
+        cases = (
+            ("search", lambda: len(list(engine.query(search)))),
+            ("range count", lambda: engine.query_count(in_range)),
+            ("email eq", lambda: len(list(engine.query(email)))),
+            ("email in", lambda: len(list(engine.query(emails)))))
+        for label, func in cases:
+            print("engine {:<15} {:<11} {:>8.1f} ms ({})".format(
+                name, label, timed(func), func()))
+        del engine
+        DATA['User'] = {}
+        base.INDEX['User'] = {}
+    columnar_storage.numpy = numpy
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        sys.path.insert(0, os.getcwd())
+        os.chdir(directory)
+        bench_load()
+        bench_threads()
+        bench_import()
+        bench_listing()
+        bench_memory()
+        bench_columnar()
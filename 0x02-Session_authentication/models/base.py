@@ -1,40 +1,430 @@
 #!/usr/bin/env python3
 """ Base module
 """
+from contextlib import contextmanager
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from typing import TypeVar, List, Iterable, Iterator
+from os import getenv, path
+import atexit
+import fcntl
 import json
+import os
+import re
+import threading
+import time
 import uuid
+from models.query import Query
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
 DATA = {}
+INDEX = {}
+JOURNAL_MODE = getenv("BASE_JOURNAL_MODE", "0") == "1"
+JOURNAL_COMPACT_SIZE = int(getenv("BASE_JOURNAL_COMPACT_SIZE", 4 * 2 ** 20))
+WRITE_BEHIND_INTERVAL = float(getenv("BASE_WRITE_BEHIND_INTERVAL", 0))
+WRITE_BEHIND_MAX_DIRTY = int(getenv("BASE_WRITE_BEHIND_MAX_DIRTY", 100))
+LOAD_WORKERS = int(getenv("BASE_LOAD_WORKERS", 0))
+STORAGE_ENGINE = getenv("BASE_STORAGE", "file")
+SQLITE_PATH = getenv("BASE_SQLITE_PATH", ".db.sqlite3")
+# seconds a process may serve data older than the files, 0: never check
+SYNC_INTERVAL = float(getenv("BASE_SYNC_INTERVAL", 1))
+# keep the to_json(True) bytes on the objects: faster file rewrites,
+# about 300 bytes more per object
+SNAPSHOT_CACHE = getenv("BASE_SNAPSHOT_CACHE", "0") == "1"
+# batches open in any thread, attribute sets tell the engine then
+OPEN_BATCHES = 0
+# models in slots, see models.compact
+COMPACT_MODELS = getenv("BASE_COMPACT_MODELS", "0") == "1"
+# end of a record and start of the next one in a json.dump of DATA
+RECORD_BOUNDARY = re.compile(r'\}, "(?=[^"\\]*": \{)')
+
+
+def parse_timestamp(value: str) -> datetime:
+    """ Parse a TIMESTAMP_FORMAT string, with the fast ISO parser
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+def _parse_records(text: str) -> list:
+    """ Parse the records of a chunk of a file, in a worker process
+    """
+    records = list(json.loads("{" + text + "}").values())
+    for record in records:
+        for key in ('created_at', 'updated_at'):
+            if record.get(key) is not None:
+                record[key] = parse_timestamp(record[key])
+    return records
+
+
+def _split_records(text: str, parts: int) -> List[str]:
+    """ Split the records of a json.dump of DATA in parts chunks
+    """
+    body = text.strip()[1:-1]
+    chunks = []
+    start = 0
+    for n in range(1, parts):
+        match = RECORD_BOUNDARY.search(body, max(start,
+                                                 len(body) * n // parts))
+        if match is None:
+            break
+        chunks.append(body[start:match.start() + 1])
+        start = match.end() - 1
+    chunks.append(body[start:])
+    return chunks
+
+
+class WriteBehind():
+    """ Background flusher: saves only mark their class dirty, the
+    files are rewritten at most once per interval or after max_dirty
+    writes, coalescing the writes in between
+    """
+
+    def __init__(self, interval: float, max_dirty: int):
+        """ Initialize a flusher, its thread starts on the first write
+        """
+        self.interval = interval
+        self.max_dirty = max_dirty
+        self.dirty = {}
+        self.pending = 0
+        self.stats = {"flushes": 0, "coalesced_writes": 0,
+                      "last_coalesced": 0, "last_latency": 0.0,
+                      "max_latency": 0.0, "total_latency": 0.0}
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def mark(self, cls: type):
+        """ Record one write of cls to flush later
+        """
+        with self._cond:
+            self.dirty[cls.__name__] = cls
+            self.pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            if self.pending >= self.max_dirty:
+                self._cond.notify()
+
+    def flush(self):
+        """ Rewrite the files of all dirty classes now
+        """
+        with self._flush_lock:
+            with self._cond:
+                dirty, writes = self.dirty, self.pending
+                self.dirty, self.pending = {}, 0
+            if not dirty:
+                return
+            start = time.perf_counter()
+            for cls in dirty.values():
+                cls.save_to_file()
+            latency = time.perf_counter() - start
+            self.stats["flushes"] += 1
+            self.stats["coalesced_writes"] += writes
+            self.stats["last_coalesced"] = writes
+            self.stats["last_latency"] = latency
+            self.stats["total_latency"] += latency
+            self.stats["max_latency"] = max(self.stats["max_latency"],
+                                            latency)
+
+    def _run(self):
+        """ Flush loop of the background thread
+        """
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self.pending >= self.max_dirty, self.interval)
+            self.flush()
+
+
+class _Held():
+    """ Context manager calling an acquire and a release function
+    """
+
+    def __init__(self, acquire, release):
+        """ Initialize with the two functions
+        """
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        """ Acquire
+        """
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        """ Release
+        """
+        self.release()
+
+
+class RWLock():
+    """ Reader/writer lock: many readers or one writer. Writers go
+    first once waiting, the writer may take the lock again or read
+    under it, readers must not nest
+    """
+
+    def __init__(self):
+        """ Initialize an unlocked lock
+        """
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._depth = 0
+        self._waiting = 0
+        self._read = _Held(self.acquire_read, self.release_read)
+        self._write = _Held(self.acquire_write, self.release_write)
+
+    def read(self) -> _Held:
+        """ Context manager holding the lock shared
+        """
+        return self._read
+
+    def write(self) -> _Held:
+        """ Context manager holding the lock exclusive
+        """
+        return self._write
+
+    def acquire_read(self):
+        """ Take the lock shared
+        """
+        if self._writer == threading.get_ident():
+            return
+        with self._cond:
+            while self._writer is not None or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        """ Release a shared hold
+        """
+        if self._writer == threading.get_ident():
+            return
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        """ Take the lock exclusive
+        """
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._depth += 1
+                return
+            self._waiting += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer, self._depth = me, 1
+
+    def release_write(self):
+        """ Release an exclusive hold
+        """
+        with self._cond:
+            self._depth -= 1
+            if not self._depth:
+                self._writer = None
+                self._cond.notify_all()
+
+
+class FileLock():
+    """ Lock ordering the writes to the files of a class, between the
+    threads of this process and between processes: a reentrant lock,
+    plus flock on the .db_X.lock file while it is held
+    """
+
+    def __init__(self, lock_path: str):
+        """ Initialize the lock of lock_path
+        """
+        self.path = lock_path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """ Take the lock, False if not blocking and it is held
+        """
+        if not self._lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking
+                            else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # another process holds it
+                os.close(fd)
+                self._lock.release()
+                return False
+            self._fd = fd
+        self._depth += 1
+        return True
+
+    def release(self):
+        """ Release one hold of the lock
+        """
+        self._depth -= 1
+        if self._depth == 0:
+            fd, self._fd = self._fd, None
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self._lock.release()
+
+    def __enter__(self) -> 'FileLock':
+        """ Take the lock
+        """
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        """ Release the lock
+        """
+        self.release()
+
+
+LOCKS = {}
+FILE_LOCKS = {}
+SYNC = {}
+_locks_lock = threading.Lock()
+
+
+def lock(s_class: str) -> RWLock:
+    """ Reader/writer lock guarding DATA and INDEX of a class
+    """
+    rw_lock = LOCKS.get(s_class)
+    if rw_lock is None:
+        with _locks_lock:
+            rw_lock = LOCKS.setdefault(s_class, RWLock())
+    return rw_lock
+
+
+def file_lock(s_class: str) -> FileLock:
+    """ Lock ordering the writes to the files of a class, across
+    processes
+    """
+    f_lock = FILE_LOCKS.get(s_class)
+    if f_lock is None:
+        with _locks_lock:
+            f_lock = FILE_LOCKS.setdefault(
+                s_class, FileLock(".db_{}.lock".format(s_class)))
+    return f_lock
+
+
+def sync_state(s_class: str) -> dict:
+    """ What this process last saw of the files of a class: signature
+    of the snapshot, inode of the journal and how far it was read
+    """
+    state = SYNC.get(s_class)
+    if state is None:
+        state = SYNC.setdefault(s_class, {
+            "snapshot": None, "journal": None, "offset": 0,
+            "checked": time.monotonic()})
+    return state
+
+
+def file_signature(file_path: str) -> tuple:
+    """ Inode, modification time and size of a file, None if missing
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def write_snapshot(s_class: str, objs: Iterable[tuple]):
+    """ Write the .db_X.json file of (id, object) pairs, under the file
+    lock of the class
+    """
+    file_path = ".db_{}.json".format(s_class)
+    # the json.dump of the objects, from their cached bytes
+    dump = b'{' + b', '.join(
+        json.dumps(obj_id).encode() + b': ' + obj.to_json_bytes(True)
+        for obj_id, obj in objs) + b'}'
+
+    # readers never see a half written file
+    tmp_path = "{}.tmp".format(file_path)
+    with open(tmp_path, 'wb') as f:
+        f.write(dump)
+    os.replace(tmp_path, file_path)
+    # our own write, nothing to sync from
+    sync_state(s_class)["snapshot"] = file_signature(file_path)
+
+
+WRITE_BEHIND = None
+if WRITE_BEHIND_INTERVAL > 0:
+    WRITE_BEHIND = WriteBehind(WRITE_BEHIND_INTERVAL, WRITE_BEHIND_MAX_DIRTY)
+STORAGE = None
+
+
+def storage():
+    """ Storage engine chosen by BASE_STORAGE: file (default), sqlite
+    or columnar
+    """
+    global STORAGE
+    if STORAGE is None:
+        # imported here, the engines need this module loaded
+        if STORAGE_ENGINE == "sqlite":
+            from models.engine.sqlite_storage import SQLiteStorage
+            STORAGE = SQLiteStorage(SQLITE_PATH)
+        elif STORAGE_ENGINE == "columnar":
+            from models.engine.columnar_storage import ColumnarStorage
+            STORAGE = ColumnarStorage()
+        else:
+            from models.engine.file_storage import FileStorage
+            STORAGE = FileStorage()
+    return STORAGE
 
 
 class Base():
     """ Base class
     """
+    # attributes with a secondary index used by search
+    INDEXES = ()
+    # serializations cached out of __dict__, valid for one _version
+    __slots__ = ('__dict__', '__weakref__', '_version', '_cached')
+    # where __setattr__ stores a value
+    _assign = object.__setattr__
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
         s_class = str(self.__class__.__name__)
-        if DATA.get(s_class) is None:
-            DATA[s_class] = {}
+        DATA.setdefault(s_class, {})
 
-        self.id = kwargs.get('id', str(uuid.uuid4()))
+        # no throwaway uuid when the id is given
+        self.id = kwargs['id'] if 'id' in kwargs else str(uuid.uuid4())
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self.created_at = parse_timestamp(kwargs.get('created_at'))
         else:
             self.created_at = datetime.utcnow()
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self.updated_at = parse_timestamp(kwargs.get('updated_at'))
         else:
             self.updated_at = datetime.utcnow()
 
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, keeping the indexes of a stored object
+        """
+        if OPEN_BATCHES and self._is_stored():
+            STORAGE.before_change(self)
+        if name in self.INDEXES and self._is_stored():
+            with lock(self.__class__.__name__).write():
+                self._unindex(name)
+                self._assign(name, value)
+                self._index(name)
+        else:
+            self._assign(name, value)
+        # set after the value: a serialization made meanwhile is stale
+        object.__setattr__(self, '_version',
+                           getattr(self, '_version', 0) + 1)
+
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
         """
@@ -45,68 +435,307 @@ class Base():
         return (self.id == other.id)
 
     def to_json(self, for_serialization: bool = False) -> dict:
+        """ Convert the object a JSON dictionary, a copy of the one
+        cached since the last attribute set. to_json(True) is rebuilt
+        every time
+        """
+        if for_serialization:
+            return self._to_json(True)
+        cached = self._cache()
+        if cached[1] is None:
+            cached[1] = self._to_json()
+        return dict(cached[1])
+
+    def to_json_bytes(self, for_serialization: bool = False) -> bytes:
+        """ to_json encoded by json.dumps, cached like to_json. The
+        to_json(True) bytes, for the files, only with SNAPSHOT_CACHE
+        """
+        if for_serialization and not SNAPSHOT_CACHE:
+            return json.dumps(self._to_json(True)).encode()
+        cached = self._cache()
+        i = 3 if for_serialization else 2
+        if cached[i] is None:
+            # the dict is not kept, only to_json keeps it
+            cached[i] = json.dumps(self._to_json(for_serialization)) \
+                .encode()
+        return cached[i]
+
+    def _cache(self) -> list:
+        """ Serializations made since the last attribute set: version,
+        to_json, its bytes and the to_json(True) bytes. Values changed
+        in place are not seen
+        """
+        cached = getattr(self, '_cached', None)
+        version = getattr(self, '_version', 0)
+        if cached is None or cached[0] != version:
+            cached = [version, None, None, None]
+            object.__setattr__(self, '_cached', cached)
+        return cached
+
+    def _to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
         result = {}
         for key, value in self.__dict__.items():
             if not for_serialization and key[0] == '_':
                 continue
-            if type(value) is datetime:
-                result[key] = value.strftime(TIMESTAMP_FORMAT)
-            else:
+            if type(value) is not datetime:
                 result[key] = value
+            elif value.tzinfo is None:
+                # TIMESTAMP_FORMAT, without going through strftime
+                result[key] = value.isoformat(timespec='seconds')
+            else:
+                result[key] = value.strftime(TIMESTAMP_FORMAT)
         return result
 
     @classmethod
-    def load_from_file(cls):
-        """ Load all objects from file
+    def load_from_file(cls, workers: int = None):
+        """ Load all objects through the storage engine
+        workers: processes parsing chunks of the file, BASE_LOAD_WORKERS
+        by default, 0 to parse it in this process
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
+        storage().load(cls, workers)
+
+    @classmethod
+    def bulk_load(cls, records: Iterable[dict]):
+        """ Store the objects built from records
+        """
+        objs = DATA[cls.__name__]
+        for obj in cls.from_records(records):
+            objs[obj.id] = obj
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+    @classmethod
+    def from_records(cls, records: Iterable[dict]) -> Iterator['Base']:
+        """ Build objects from records without going through __init__:
+        one object of the class gives the attributes and their
+        defaults, the records only override them
+        records: dicts of to_json(True), datetimes already parsed
+        """
+        template = cls()
+        defaults = list(template.__dict__.items())
+        keys = template.__dict__.keys()
+        new = cls.__new__
+        for record in records:
+            if record.get('id') is None or \
+                    record.get('created_at') is None or \
+                    record.get('updated_at') is None:
+                obj = cls(**{k: v.strftime(TIMESTAMP_FORMAT)
+                             if type(v) is datetime else v
+                             for k, v in record.items()})
+            elif record.keys() == keys:
+                # the usual case, the record is the whole object state
+                obj = new(cls)
+                obj.__dict__ = record
+            else:
+                obj = new(cls)
+                obj.__dict__.update({k: record.get(k, v)
+                                     for k, v in defaults})
+            yield obj
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
+        storage().dump(cls)
+
+    @classmethod
+    def append_to_journal(cls, op: str, obj: TypeVar('Base')):
+        """ Append one save or remove entry to the journal, compacting
+        it once it passes JOURNAL_COMPACT_SIZE
+        """
+        cls._append_entry(cls._journal_entry(op, obj))
+
+    @classmethod
+    def append_batch_to_journal(cls, changes: Iterable[tuple]):
+        """ Append (op, obj) changes as a single entry: a crash keeps
+        all of them or none
+        """
+        cls._append_entry({"op": "batch", "entries": [
+            cls._journal_entry(op, obj) for op, obj in changes]})
+
+    @staticmethod
+    def _journal_entry(op: str, obj: TypeVar('Base')) -> dict:
+        """ Journal entry of one save or remove
+        """
+        entry = {"op": op, "id": obj.id}
+        if op == "save":
+            entry["obj"] = obj.to_json(True)
+        return entry
+
+    @classmethod
+    def _append_entry(cls, entry: dict):
+        """ Append an entry as one line of the journal
+        """
+        line = json.dumps(entry) + "\n"
+        journal_path = ".db_{}.journal".format(cls.__name__)
+        with file_lock(cls.__name__), open(journal_path, 'a') as f:
+            f.write(line)
+            size = f.tell()
+            # skip our own entry when syncing, unless others wrote first
+            state = sync_state(cls.__name__)
+            start = size - len(line)
+            inode = os.fstat(f.fileno()).st_ino
+            if state["journal"] == inode and state["offset"] == start or \
+                    state["journal"] != inode and start == 0:
+                state["journal"], state["offset"] = inode, size
+        if size > JOURNAL_COMPACT_SIZE:
+            cls.compact()
+
+    @classmethod
+    def persist(cls):
+        """ Save all objects to file now, or later in write-behind mode
+        """
+        if WRITE_BEHIND is not None:
+            WRITE_BEHIND.mark(cls)
+        else:
+            cls.save_to_file()
+
+    @staticmethod
+    def flush():
+        """ Write the changes the write-behind flusher still holds
+        """
+        if WRITE_BEHIND is not None:
+            WRITE_BEHIND.flush()
+
+    @staticmethod
+    def write_behind_stats() -> dict:
+        """ Flush count, latencies and writes coalesced per flush
+        """
+        if WRITE_BEHIND is None:
+            return {}
+        stats = dict(WRITE_BEHIND.stats)
+        flushes = stats["flushes"] or 1
+        stats["avg_latency"] = stats["total_latency"] / flushes
+        stats["avg_coalesced"] = stats["coalesced_writes"] / flushes
+        stats["pending"] = WRITE_BEHIND.pending
+        return stats
+
+    @classmethod
+    def compact(cls):
+        """ Fold the journal into a new snapshot
+        """
+        # no append between the snapshot and the removal, from any
+        # process: save_to_file reads the entries of the others first
+        with file_lock(cls.__name__):
+            cls.save_to_file()
+            journal_path = ".db_{}.journal".format(cls.__name__)
+            if path.exists(journal_path):
+                os.remove(journal_path)
+            state = sync_state(cls.__name__)
+            state["journal"], state["offset"] = None, 0
+
+    @classmethod
+    def build_indexes(cls):
+        """ Rebuild the secondary indexes from all objects
+        """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        with lock(s_class).write():
+            INDEX[s_class] = {attr: {} for attr in cls.INDEXES}
+            for obj in DATA[s_class].values():
+                obj._index_all()
+
+    def _is_stored(self) -> bool:
+        """ Whether this very object is the one stored under its id
+        """
+        stored = DATA.get(self.__class__.__name__, {})
+        return stored.get(getattr(self, 'id', None)) is self
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+    def _state(self) -> dict:
+        """ Attributes of the object, as from_records receives them
+        """
+        return self.__dict__
+
+    def _index(self, attr: str):
+        """ Add this object to the index of attr
+        """
+        index = INDEX.setdefault(self.__class__.__name__, {}) \
+            .setdefault(attr, {})
+        # dict buckets keep the ids in insertion order
+        index.setdefault(getattr(self, attr, None), {})[self.id] = None
+
+    def _unindex(self, attr: str):
+        """ Remove this object from the index of attr
+        """
+        index = INDEX.get(self.__class__.__name__, {}).get(attr, {})
+        value = getattr(self, attr, None)
+        bucket = index.get(value)
+        if bucket is not None:
+            bucket.pop(self.id, None)
+            if not bucket:
+                del index[value]
+
+    def _index_all(self):
+        """ Add this object to all the indexes of its class
+        """
+        for attr in self.INDEXES:
+            self._index(attr)
+
+    def _unindex_all(self):
+        """ Remove this object from all the indexes of its class
+        """
+        for attr in self.INDEXES:
+            self._unindex(attr)
 
     def save(self):
         """ Save current object
         """
-        s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        storage().save(self)
 
     def remove(self):
         """ Remove object
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        storage().remove(self)
+
+    @classmethod
+    def save_many(cls, objs: Iterable[TypeVar('Base')]):
+        """ Save objects, all persisted with a single flush
+        """
+        with cls.batch():
+            for obj in objs:
+                obj.save()
+
+    @classmethod
+    def remove_many(cls, ids: Iterable[str]) -> int:
+        """ Remove the objects with these IDs, all persisted with a
+        single flush
+        Return:
+          - the number of objects removed
+        """
+        removed = 0
+        with cls.batch():
+            for obj_id in ids:
+                obj = cls.get(obj_id)
+                if obj is not None:
+                    obj.remove()
+                    removed += 1
+        return removed
+
+    @staticmethod
+    @contextmanager
+    def batch():
+        """ Group the saves and removes of this thread: they show in
+        memory right away, and persist with a single flush when the
+        block ends. An exception writes nothing and puts back what was
+        stored before the block, as new objects: the objects the block
+        changed keep their attributes. Nested batches join the outer one.
+        Files written before the end, by the write-behind flusher or the
+        saves of other threads, hold the objects as they were before it
+        """
+        engine = storage()
+        engine.begin()
+        try:
+            yield
+        except BaseException:
+            engine.end(False)
+            raise
+        engine.end(True)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        return storage().count(cls)
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -118,20 +747,17 @@ class Base():
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return storage().get(cls, id)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
-        s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+        return storage().search(cls, attributes)
+
+    @classmethod
+    def query(cls, attributes: dict = {}) -> Query:
+        """ Lazy query on all objects, starting from the attributes
+        search would match
+        """
+        return Query(cls, attributes)
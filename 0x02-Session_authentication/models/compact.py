@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+""" Compact module: models keeping their state in __slots__
+"""
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+import sys
+from models.base import Base, TIMESTAMP_FORMAT
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(value: datetime) -> int:
+    """ Seconds since EPOCH of a naive UTC datetime
+    """
+    return int((value - EPOCH).total_seconds())
+
+
+def from_epoch(seconds: int) -> datetime:
+    """ Naive UTC datetime of seconds since EPOCH
+    """
+    return EPOCH + timedelta(seconds=seconds)
+
+
+class CompactBase(Base):
+    """ Base storing its attributes in slots, no __dict__ per object:
+    timestamps as integer seconds (the precision of TIMESTAMP_FORMAT)
+    and the strings of INTERNED attributes interned, shared by all the
+    objects holding them. Attributes out of FIELDS go to the _extra
+    dict, made for the first one. __dict__ is never touched: reading it
+    would create it
+    """
+    __slots__ = ('id', '_created', '_updated', '_extra')
+    # attributes after id, created_at and updated_at, in to_json order
+    FIELDS = ()
+    # attributes whose strings repeat across objects
+    INTERNED = ()
+
+    @property
+    def created_at(self) -> datetime:
+        """ Creation time
+        """
+        return from_epoch(self._created)
+
+    @created_at.setter
+    def created_at(self, value: datetime):
+        """ Set the creation time
+        """
+        object.__setattr__(self, '_created', to_epoch(value))
+
+    @property
+    def updated_at(self) -> datetime:
+        """ Last update time
+        """
+        return from_epoch(self._updated)
+
+    @updated_at.setter
+    def updated_at(self, value: datetime):
+        """ Set the last update time
+        """
+        object.__setattr__(self, '_updated', to_epoch(value))
+
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, interning the strings of INTERNED
+        """
+        if name in self.INTERNED and type(value) is str:
+            value = sys.intern(value)
+        super().__setattr__(name, value)
+
+    def _assign(self, name: str, value):
+        """ Store a value: in its slot or property, in _extra otherwise
+        """
+        if hasattr(type(self), name):
+            object.__setattr__(self, name, value)
+            return
+        extra = getattr(self, '_extra', None)
+        if extra is None:
+            extra = {}
+            object.__setattr__(self, '_extra', extra)
+        extra[name] = value
+
+    def __getattr__(self, name: str):
+        """ Attributes out of FIELDS, from _extra
+        """
+        if name != '_extra':
+            extra = getattr(self, '_extra', None)
+            if extra is not None and name in extra:
+                return extra[name]
+        raise AttributeError("'{}' object has no attribute '{}'".format(
+            type(self).__name__, name))
+
+    def _state(self) -> dict:
+        """ What __dict__ would hold for the same object out of slots
+        """
+        state = {'id': self.id, 'created_at': self.created_at,
+                 'updated_at': self.updated_at}
+        for name in self.FIELDS:
+            state[name] = getattr(self, name, None)
+        state.update(getattr(self, '_extra', None) or {})
+        return state
+
+    def _to_json(self, for_serialization: bool = False) -> dict:
+        """ Convert the object a JSON dictionary, like Base does for the
+        same attributes in __dict__
+        """
+        result = {'id': self.id,
+                  'created_at': self._timestamp(self._created),
+                  'updated_at': self._timestamp(self._updated)}
+        for name in self.FIELDS:
+            if for_serialization or name[0] != '_':
+                result[name] = getattr(self, name, None)
+        for key, value in (getattr(self, '_extra', None) or {}).items():
+            if for_serialization or key[0] != '_':
+                if type(value) is datetime:
+                    value = value.strftime(TIMESTAMP_FORMAT)
+                result[key] = value
+        return result
+
+    @staticmethod
+    def _timestamp(seconds: int) -> str:
+        """ TIMESTAMP_FORMAT string of seconds since EPOCH
+        """
+        return from_epoch(seconds).isoformat(timespec='seconds')
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict]) -> Iterator['Base']:
+        """ Build objects from records without going through __init__,
+        straight into their slots
+        records: dicts of to_json(True), datetimes already parsed
+        """
+        new = cls.__new__
+        set_slot = object.__setattr__
+        fields = [name for name in cls.FIELDS if name not in cls.INTERNED]
+        interned = list(cls.INTERNED)
+        intern = sys.intern
+        known = set(fields + interned + ['id', 'created_at', 'updated_at'])
+        for record in records:
+            if record.get('id') is None or \
+                    record.get('created_at') is None or \
+                    record.get('updated_at') is None:
+                yield cls(**{k: v.strftime(TIMESTAMP_FORMAT)
+                             if type(v) is datetime else v
+                             for k, v in record.items()})
+                continue
+            obj = new(cls)
+            set_slot(obj, 'id', record['id'])
+            set_slot(obj, '_created', to_epoch(record['created_at']))
+            set_slot(obj, '_updated', to_epoch(record['updated_at']))
+            get = record.get
+            for name in fields:
+                set_slot(obj, name, get(name))
+            for name in interned:
+                value = get(name)
+                set_slot(obj, name, intern(value)
+                         if type(value) is str else value)
+            extra = {key: record[key] for key in record.keys() - known}
+            if extra:
+                set_slot(obj, '_extra', extra)
+            yield obj
+
+
+def compact(cls: type, interned: Iterable[str] = ()) -> type:
+    """ Compact variant of a model class: same name, so the same DATA
+    entry and files, same behavior, attributes in slots
+    cls: model class, its attributes are the ones __init__ sets
+    interned: attributes whose strings repeat across objects
+    """
+    fields = tuple(name for name in cls().__dict__
+                   if name not in ('id', 'created_at', 'updated_at'))
+    return type(cls.__name__, (CompactBase, cls), {
+        '__slots__': fields, '__module__': cls.__module__,
+        '__qualname__': cls.__qualname__, '__doc__': cls.__doc__,
+        'FIELDS': fields, 'INTERNED': tuple(interned)})
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+""" Columnar storage engine: one typed array per attribute, searched by
+whole-column masks
+"""
+from array import array
+from datetime import datetime, timedelta
+from itertools import islice
+from os import path
+from typing import Callable, Iterator, List, TypeVar
+import threading
+from models import base
+from models.engine.storage import Storage
+from models.query import Query
+try:
+    import numpy
+except ImportError:
+    # searches loop over the arrays in Python instead
+    numpy = None
+
+EPOCH = datetime(1970, 1, 1)
+# the attributes stored as TimeColumn
+TIME_ATTRIBUTES = ('created_at', 'updated_at')
+# a row built from an object without this attribute
+MISSING = object()
+
+
+class DictColumn():
+    """ Dictionary encoded column: every distinct value once in values,
+    rows hold the index of their value. Code 0 is MISSING
+    """
+    typecode = 'i'
+
+    def __init__(self, size: int = 0):
+        """ Initialize a column of size MISSING rows
+        """
+        self.values = [MISSING]
+        # code of the first value of each group of equal values, the
+        # others (1, 1.0 and True) in aliases
+        self.lookup = {}
+        self.aliases = {}
+        # unhashable values, never shared
+        self.unhashable = []
+        self.codes = array(self.typecode, bytes(4 * size))
+
+    def encode(self, value) -> int:
+        """ Code of a value, added to the dictionary if new
+        """
+        if value is MISSING:
+            return 0
+        try:
+            code = self.lookup.get(value)
+        except TypeError:
+            code = len(self.values)
+            self.values.append(value)
+            self.unhashable.append(code)
+            return code
+        if code is not None:
+            if type(self.values[code]) is type(value):
+                return code
+            # an equal value of another type, kept apart
+            for alias in self.aliases.get(value, ()):
+                if type(self.values[alias]) is type(value):
+                    return alias
+        new = len(self.values)
+        self.values.append(value)
+        if code is None:
+            self.lookup[value] = new
+        else:
+            self.aliases.setdefault(value, []).append(new)
+        return new
+
+    def equal_codes(self, value) -> List[int]:
+        """ Codes of the values equal to value
+        """
+        try:
+            code = self.lookup.get(value)
+        except TypeError:
+            return [code for code in self.unhashable
+                    if self.values[code] == value]
+        if code is None:
+            return []
+        return [code] + self.aliases.get(value, [])
+
+    def append(self, value):
+        """ Add a row
+        """
+        self.codes.append(self.encode(value))
+
+    def set(self, row: int, value):
+        """ Change the value of a row
+        """
+        self.codes[row] = self.encode(value)
+
+    def get(self, row: int):
+        """ Value of a row
+        """
+        return self.values[self.codes[row]]
+
+    def select(self, rows: List[int]) -> 'DictColumn':
+        """ New column of these rows, without the values they don't hold
+        """
+        column = DictColumn()
+        values, codes = self.values, self.codes
+        for row in rows:
+            column.append(values[codes[row]])
+        return column
+
+    def garbage(self, live: int) -> int:
+        """ Least number of values no row holds, for live rows
+        """
+        return len(self.values) - 1 - live
+
+    def codes_where(self, test: Callable) -> List[int]:
+        """ Codes of the distinct values passing test
+        """
+        codes = []
+        for code, value in enumerate(self.values):
+            if value is MISSING:
+                continue
+            try:
+                if test(value):
+                    codes.append(code)
+            except TypeError:
+                continue
+        return codes
+
+
+class TimeColumn():
+    """ Column of datetimes as microseconds since EPOCH
+    """
+    typecode = 'q'
+    NONE = -2 ** 63
+    MISSING = -2 ** 63 + 1
+
+    def __init__(self, size: int = 0):
+        """ Initialize a column of size MISSING rows
+        """
+        self.codes = array(self.typecode, [self.MISSING]) * size
+
+    def encode(self, value) -> int:
+        """ Microseconds of a datetime, or a marker
+        """
+        if value is MISSING:
+            return self.MISSING
+        if value is None:
+            return self.NONE
+        delta = value - EPOCH
+        return (delta.days * 86400 + delta.seconds) * 10 ** 6 + \
+            delta.microseconds
+
+    def append(self, value):
+        """ Add a row
+        """
+        self.codes.append(self.encode(value))
+
+    def set(self, row: int, value):
+        """ Change the value of a row
+        """
+        self.codes[row] = self.encode(value)
+
+    def select(self, rows: List[int]) -> 'TimeColumn':
+        """ New column of these rows
+        """
+        column = TimeColumn()
+        codes = self.codes
+        column.codes = array(self.typecode, (codes[row] for row in rows))
+        return column
+
+    @staticmethod
+    def garbage(live: int) -> int:
+        """ Values no row holds: none, values live in the rows
+        """
+        return 0
+
+    def get(self, row: int):
+        """ Value of a row
+        """
+        code = self.codes[row]
+        if code == self.NONE:
+            return None
+        if code == self.MISSING:
+            return MISSING
+        return EPOCH + timedelta(microseconds=code)
+
+
+class Table():
+    """ Rows of one class: ids, alive flags and a column per attribute
+    in the order of the attributes of the objects. Dead rows and the
+    values no row holds are dropped once they outnumber the live rows,
+    rows are renumbered then
+    """
+    # garbage always tolerated, rows or values
+    MIN_GARBAGE = 1000
+
+    def __init__(self):
+        """ Initialize an empty table
+        """
+        self.ids = []
+        self.positions = {}
+        self.alive = bytearray()
+        self.dead = 0
+        self.columns = {}
+        self.order = ['id']
+
+    def _column(self, attr: str):
+        """ Column of attr, created MISSING for the rows already there
+        """
+        column = self.columns.get(attr)
+        if column is None:
+            kind = TimeColumn if attr in TIME_ATTRIBUTES else DictColumn
+            column = self.columns[attr] = kind(len(self.ids))
+            self.order.append(attr)
+        return column
+
+    def write(self, state: dict) -> int:
+        """ Store the attributes of an object in its row, a new one
+        if its id has none
+        """
+        for attr in state:
+            if attr != 'id':
+                self._column(attr)
+        obj_id = state['id']
+        row = self.positions.get(obj_id)
+        if row is None:
+            row = len(self.ids)
+            self.ids.append(obj_id)
+            self.alive.append(1)
+            self.positions[obj_id] = row
+            for attr, column in self.columns.items():
+                column.append(state.get(attr, MISSING))
+            return row
+        for attr, column in self.columns.items():
+            column.set(row, state.get(attr, MISSING))
+        self._collect()
+        return row
+
+    def delete(self, obj_id: str) -> bool:
+        """ Drop the row of an id, its slot stays dead
+        """
+        row = self.positions.pop(obj_id, None)
+        if row is None:
+            return False
+        self.alive[row] = 0
+        self.ids[row] = None
+        self.dead += 1
+        self._collect()
+        return True
+
+    def _collect(self):
+        """ Compact the table if its garbage outnumbers the live rows
+        """
+        live = len(self.positions)
+        limit = live + self.MIN_GARBAGE
+        if self.dead > limit or \
+                any(column.garbage(live) > limit
+                    for column in self.columns.values()):
+            self.compact()
+
+    def compact(self):
+        """ Drop the dead rows and the values no row holds, the rows
+        left renumbered in the same order
+        """
+        alive = self.alive
+        rows = [row for row in range(len(self.ids)) if alive[row]]
+        self.columns = {attr: column.select(rows)
+                        for attr, column in self.columns.items()}
+        self.ids = [self.ids[row] for row in rows]
+        self.positions = {obj_id: row for row, obj_id in enumerate(self.ids)}
+        self.alive = bytearray(b'\x01') * len(rows)
+        self.dead = 0
+
+    def record(self, row: int) -> dict:
+        """ Attributes of a row, as to_json(True) with datetimes
+        """
+        record = {}
+        for attr in self.order:
+            if attr == 'id':
+                record['id'] = self.ids[row]
+                continue
+            value = self.columns[attr].get(row)
+            if value is not MISSING:
+                record[attr] = value
+        return record
+
+
+class ColumnarStorage(Storage):
+    """ Objects live as rows of in-memory columns, persisted to the
+    .db_X.json file of the file engine. get, search, all and queries
+    build objects from rows, different objects on every call.
+    Equality, in, prefix and range predicates are evaluated on whole
+    columns, with NumPy when it is installed
+    """
+
+    def __init__(self):
+        """ Initialize the engine
+        """
+        self.tables = {}
+        self._batch = threading.local()
+
+    def _table(self, cls: type) -> Table:
+        """ Table of cls
+        """
+        table = self.tables.get(cls.__name__)
+        if table is None:
+            table = self.tables.setdefault(cls.__name__, Table())
+        return table
+
+    def load(self, cls: type, workers: int = None):
+        """ Load all objects of cls from its JSON file
+        """
+        s_class = cls.__name__
+        file_path = ".db_{}.json".format(s_class)
+        table = Table()
+        if path.exists(file_path):
+            with open(file_path, 'r') as f:
+                text = f.read()
+            for record in base._parse_records(text.strip()[1:-1]):
+                table.write(record)
+        with base.lock(s_class).write():
+            self.tables[s_class] = table
+
+    def _objects(self, cls: type, ids: Iterator[str]) \
+            -> Iterator[TypeVar('Base')]:
+        """ Objects built from their rows as they are consumed, by id:
+        rows move when the table is compacted. Ids removed meanwhile
+        are skipped
+        """
+        rw_lock = base.lock(cls.__name__)
+
+        def records():
+            chunk = list(islice(ids, 1000))
+            while chunk:
+                with rw_lock.read():
+                    # the table of the class, reloaded meanwhile or not
+                    table = self._table(cls)
+                    positions = table.positions
+                    found = [table.record(positions[obj_id])
+                             for obj_id in chunk if obj_id in positions]
+                yield from found
+                chunk = list(islice(ids, 1000))
+
+        return cls.from_records(records())
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object by ID
+        """
+        table = self._table(cls)
+        with base.lock(cls.__name__).read():
+            row = table.positions.get(id)
+            if row is None:
+                return None
+            record = table.record(row)
+        return next(cls.from_records([record]))
+
+    def search(self, cls: type,
+               attributes: dict = {}) -> List[TypeVar('Base')]:
+        """ Search all objects with matching attributes
+        """
+        return list(self.query(Query(cls, attributes)))
+
+    def _ids(self, query: Query, paged: bool = False) -> List[str]:
+        """ Ids of the rows matching the predicates of a query, in row
+        order, offset and limit applied when paged
+        """
+        table = self._table(query.cls)
+        with base.lock(query.cls.__name__).read():
+            rows = self._rows(table, query)
+            if paged:
+                rows = query.page(rows)
+            ids = table.ids
+            return [ids[row] for row in rows]
+
+    def _rows(self, table: Table, query: Query) -> list:
+        """ Rows matching the predicates of a query, in row order, under
+        the read lock
+        """
+        size = len(table.ids)
+        if numpy is not None:
+            mask = numpy.frombuffer(table.alive, numpy.bool_,
+                                    size).copy()
+            for predicate in query.predicates:
+                mask &= self._mask(table, size, *predicate)
+            return numpy.flatnonzero(mask).tolist()
+        rows = None
+        for predicate in query.predicates:
+            rows = self._filter(table, size, rows, *predicate)
+        if rows is None:
+            rows = range(size)
+        alive = table.alive
+        return [row for row in rows if alive[row]]
+
+    @staticmethod
+    def _tests(column, op: str, value) -> tuple:
+        """ Codes of a column a predicate keeps: a list, or a (low,
+        high) range of codes for TimeColumn ranges, None for none
+        """
+        if type(column) is TimeColumn:
+            if op == 'range':
+                low, high = value
+                return ('range',
+                        TimeColumn.MISSING + 1 if low is None
+                        else column.encode(low),
+                        2 ** 63 - 1 if high is None else column.encode(high))
+            values = (value,) if op == 'eq' else value
+            if op == 'prefix' or not all(type(v) is datetime or v is None
+                                         for v in values):
+                return ()
+            return tuple(column.encode(v) for v in values)
+        if op == 'eq':
+            return tuple(column.equal_codes(value))
+        if op == 'in':
+            codes = {}
+            for v in value:
+                codes.update(dict.fromkeys(column.equal_codes(v)))
+            return tuple(codes)
+        if op == 'prefix':
+            return tuple(column.codes_where(
+                lambda v: type(v) is str and v.startswith(value)))
+        low, high = value
+        return tuple(column.codes_where(
+            lambda v: v is not None and (low is None or not v < low) and
+            (high is None or v < high)))
+
+    def _id_rows(self, table: Table, op: str, value) -> list:
+        """ Rows of the ids an eq or in predicate on id keeps
+        """
+        values = (value,) if op == 'eq' else value
+        rows = []
+        for v in values:
+            try:
+                row = table.positions.get(v)
+            except TypeError:
+                continue
+            if row is not None:
+                rows.append(row)
+        return sorted(set(rows))
+
+    def _mask(self, table: Table, size: int, attr: str, op: str, value):
+        """ Boolean array of the rows a predicate keeps
+        """
+        if attr == 'id' and op in ('eq', 'in'):
+            mask = numpy.zeros(size, numpy.bool_)
+            mask[self._id_rows(table, op, value)] = True
+            return mask
+        column = table.columns.get(attr)
+        if column is None:
+            return numpy.zeros(size, numpy.bool_)
+        codes = numpy.frombuffer(column.codes, column.typecode, size)
+        tests = self._tests(column, op, value)
+        if tests and tests[0] == 'range':
+            return (codes >= tests[1]) & (codes < tests[2])
+        if len(tests) == 1:
+            return codes == tests[0]
+        return numpy.isin(codes, tests)
+
+    def _filter(self, table: Table, size: int, rows, attr: str, op: str,
+                value) -> list:
+        """ Rows, all when None, a predicate keeps
+        """
+        if attr == 'id' and op in ('eq', 'in'):
+            found = self._id_rows(table, op, value)
+            if rows is None:
+                return found
+            return sorted(set(found).intersection(rows))
+        column = table.columns.get(attr)
+        if column is None:
+            return []
+        codes = column.codes
+        tests = self._tests(column, op, value)
+        if rows is None and not (tests and tests[0] == 'range'):
+            return sorted(row for code in tests
+                          for row in self._scan(codes, code))
+        if rows is None:
+            rows = range(size)
+        if tests and tests[0] == 'range':
+            low, high = tests[1], tests[2]
+            return [row for row in rows if low <= codes[row] < high]
+        if len(tests) == 1:
+            code = tests[0]
+            return [row for row in rows if codes[row] == code]
+        tests = set(tests)
+        return [row for row in rows if codes[row] in tests]
+
+    @staticmethod
+    def _scan(codes: array, code: int) -> List[int]:
+        """ Rows holding code, found by array.index: the scan runs in C
+        """
+        rows = []
+        row = -1
+        try:
+            while True:
+                row = codes.index(code, row + 1)
+                rows.append(row)
+        except ValueError:
+            return rows
+
+    def query(self, query: Query) -> Iterator[TypeVar('Base')]:
+        """ Objects matching a Query, built as they are consumed
+        """
+        if query.order is not None:
+            return query.page(self._objects(query.cls,
+                                            iter(self._ids(query))))
+        return self._objects(query.cls, iter(self._ids(query, True)))
+
+    def query_count(self, query: Query) -> int:
+        """ Number of objects a Query yields, no object built
+        """
+        table = self._table(query.cls)
+        with base.lock(query.cls.__name__).read():
+            matches = len(self._rows(table, query))
+        return query.paged_count(matches)
+
+    def save(self, obj: TypeVar('Base')):
+        """ Write the row of an object, then persist
+        """
+        cls = obj.__class__
+        table = self._table(cls)
+        with base.lock(cls.__name__).write():
+            row = table.positions.get(obj.id)
+            previous = None if row is None else table.record(row)
+            table.write(dict(obj._state()))
+        self._changed(cls, obj.id, previous)
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Drop the row of an object, then persist
+        """
+        cls = obj.__class__
+        table = self._table(cls)
+        with base.lock(cls.__name__).write():
+            row = table.positions.get(obj.id)
+            if row is None:
+                return
+            previous = table.record(row)
+            table.delete(obj.id)
+        self._changed(cls, obj.id, previous)
+
+    def _changed(self, cls: type, obj_id: str, previous: dict):
+        """ Persist a change, or keep it for the end of the batch
+        """
+        changes = getattr(self._batch, "changes", None)
+        if changes is not None:
+            changes.append((cls, obj_id, previous))
+        else:
+            cls.persist()
+
+    def begin(self):
+        """ Start a batch, or join the batch of this thread
+        """
+        batch = self._batch
+        batch.depth = getattr(batch, "depth", 0) + 1
+        if batch.depth == 1:
+            batch.changes = []
+
+    def end(self, commit: bool):
+        """ End a batch: one flush per class it changed with commit,
+        its rows put back otherwise
+        """
+        batch = self._batch
+        batch.depth -= 1
+        if batch.depth > 0:
+            return
+        changes, batch.changes = batch.changes, None
+        if commit:
+            for cls in {cls: None for cls, _, _ in changes}:
+                cls.persist()
+            return
+        for cls, obj_id, previous in reversed(changes):
+            table = self._table(cls)
+            with base.lock(cls.__name__).write():
+                if previous is None:
+                    table.delete(obj_id)
+                else:
+                    table.write(previous)
+
+    def count(self, cls: type) -> int:
+        """ Count all objects
+        """
+        return len(self._table(cls).positions)
+
+    def iterate(self, cls: type) -> Iterator[TypeVar('Base')]:
+        """ Yield all objects, built as they are consumed
+        """
+        with base.lock(cls.__name__).read():
+            # in row order, rows are added in the order of their ids
+            ids = list(self._table(cls).positions)
+        return self._objects(cls, iter(ids))
@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+""" JSON file storage engine: all objects in DATA, one file per class
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, TypeVar
+import json
+import os
+import threading
+import time
+from models import base
+from models.engine.storage import Storage
+from models.query import Query
+
+
+class FileStorage(Storage):
+    """ Objects live in the DATA dict and are persisted as .db_X.json,
+    optionally with a journal or a write-behind flusher. Several
+    processes may write the same files: each one reads the changes of
+    the others before writing, under the file lock
+    """
+
+    def __init__(self):
+        """ Initialize the engine
+        """
+        self._batch = threading.local()
+        self._batches_lock = threading.Lock()
+        # per class, ids changed in DATA and not written yet: syncs
+        # keep them, the next write carries them
+        self._pending = {}
+        # per class, id -> [state before the open batches, number of
+        # batches holding it, pending before them]: snapshots write
+        # that state until the batches end
+        self._held = {}
+
+    def load(self, cls: type, workers: int = None):
+        """ Load all objects from file, then replay the journal
+        workers: processes parsing chunks of the file, BASE_LOAD_WORKERS
+        by default, 0 to parse it in this process
+        """
+        s_class = cls.__name__
+        with base.lock(s_class).write():
+            self._load(cls, workers)
+
+    def _load(self, cls: type, workers: int = None):
+        """ load, under the write lock
+        """
+        s_class = cls.__name__
+        file_path = ".db_{}.json".format(s_class)
+        base.DATA[s_class] = {}
+        self._pending.pop(s_class, None)
+        state = base.sync_state(s_class)
+        # taken first: a write after it shows up at the next sync
+        state["snapshot"] = base.file_signature(file_path)
+        state["journal"], state["offset"] = None, 0
+        if state["snapshot"] is not None:
+            with open(file_path, 'r') as f:
+                text = f.read()
+            records = None
+            if workers is None:
+                workers = base.LOAD_WORKERS
+            if workers > 1:
+                try:
+                    with ProcessPoolExecutor(max_workers=workers) as pool:
+                        records = [record for chunk in pool.map(
+                            base._parse_records,
+                            base._split_records(text, workers))
+                            for record in chunk]
+                except ValueError:
+                    # a record boundary guessed inside a value
+                    records = None
+            if records is None:
+                records = base._parse_records(text.strip()[1:-1])
+            cls.bulk_load(records)
+        self._read_journal(cls, state)
+        cls.build_indexes()
+
+    def dump(self, cls: type):
+        """ Save all objects to file, with the changes other processes
+        wrote since the last sync
+        """
+        s_class = cls.__name__
+        # the catch up, the snapshot and the write in one go: no other
+        # thread or process writes in between
+        with base.file_lock(s_class):
+            self._catch_up(cls)
+            with base.lock(s_class).read():
+                objs = list(base.DATA[s_class].items())
+                held = dict(self._held.get(s_class, {}))
+                # savers wait for the read lock, other dumps for the
+                # file lock. The changes of open batches stay pending
+                pending = self._pending.pop(s_class, set())
+                written = pending - held.keys()
+                if pending & held.keys():
+                    self._pending[s_class] = pending & held.keys()
+            try:
+                if held:
+                    objs = self._before_batches(cls, objs, held)
+                # serialized outside the lock, saves go on meanwhile
+                base.write_snapshot(s_class, objs)
+            except BaseException:
+                with base.lock(s_class).write():
+                    self._pending.setdefault(s_class, set()).update(written)
+                raise
+            if held:
+                with base.lock(s_class).write():
+                    # what was pending before the batches is written
+                    for entry in held.values():
+                        entry[2] = False
+
+    @staticmethod
+    def _before_batches(cls: type, objs: List[tuple],
+                        held: dict) -> List[tuple]:
+        """ (id, object) pairs with the objects held by open batches as
+        they were before them
+        """
+        restored = {obj.id: obj for obj in cls.from_records(
+            [dict(entry[0]) for entry in held.values()
+             if entry[0] is not None])}
+        ids = {obj_id for obj_id, obj in objs}
+        # the objects the batches created left out, the ones they
+        # removed put back
+        objs = [(obj_id, restored.get(obj_id, obj)) for obj_id, obj in objs
+                if obj_id not in held or obj_id in restored]
+        objs.extend((obj_id, obj) for obj_id, obj in restored.items()
+                    if obj_id not in ids)
+        return objs
+
+    def sync(self, cls: type):
+        """ Apply the changes other processes wrote to the files of cls,
+        checking their signatures at most once per SYNC_INTERVAL
+        """
+        s_class = cls.__name__
+        state = base.SYNC.get(s_class)
+        now = time.monotonic()
+        if base.SYNC_INTERVAL <= 0 or state is None or \
+                now - state["checked"] < base.SYNC_INTERVAL:
+            return
+        f_lock = base.file_lock(s_class)
+        if not f_lock.acquire(blocking=False):
+            # another thread syncs or writes the files right now
+            return
+        try:
+            state["checked"] = now
+            self._catch_up(cls)
+        finally:
+            f_lock.release()
+
+    def _catch_up(self, cls: type):
+        """ Read what other processes wrote to the files of cls, under
+        the file lock
+        """
+        s_class = cls.__name__
+        state = base.sync_state(s_class)
+        file_path = ".db_{}.json".format(s_class)
+        if base.file_signature(file_path) != state["snapshot"]:
+            self._read_snapshot(cls, state)
+        self._read_journal(cls, state)
+
+    def _read_snapshot(self, cls: type, state: dict):
+        """ Reload a snapshot another process wrote, replacing only the
+        objects that differ from it and are not pending here
+        """
+        s_class = cls.__name__
+        file_path = ".db_{}.json".format(s_class)
+        signature = base.file_signature(file_path)
+        records = []
+        if signature is not None:
+            with open(file_path, 'r') as f:
+                records = base._parse_records(f.read().strip()[1:-1])
+        with base.lock(s_class).write():
+            objs = base.DATA[s_class]
+            pending = self._pending.get(s_class, ())
+            ids = {record['id'] for record in records}
+            for obj_id in [i for i in objs
+                           if i not in ids and i not in pending]:
+                self._discard(objs, obj_id)
+            changed = [record for record in records
+                       if record['id'] not in pending and
+                       (objs.get(record['id']) is None or
+                        objs[record['id']]._state() != record)]
+            for obj in cls.from_records(changed):
+                self._replace(objs, obj)
+        # a new snapshot comes with a new journal, after a compaction
+        state["snapshot"] = signature
+        state["journal"], state["offset"] = None, 0
+
+    def _read_journal(self, cls: type, state: dict):
+        """ Apply the journal entries past the offset already read
+        """
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        try:
+            f = open(journal_path, 'rb')
+        except FileNotFoundError:
+            state["journal"], state["offset"] = None, 0
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != state["journal"] or st.st_size < state["offset"]:
+                state["journal"], state["offset"] = st.st_ino, 0
+            f.seek(state["offset"])
+            data = f.read()
+        # a line still being written is read next time
+        end = data.rfind(b"\n") + 1
+        with base.lock(s_class).write():
+            objs = base.DATA[s_class]
+            pending = self._pending.get(s_class, ())
+            for line in data[:end].splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a write interrupted by a crash
+                    continue
+                # a batch entry holds several changes
+                for change in entry.get("entries", [entry]):
+                    if change["id"] in pending:
+                        # our newer change, appended after this one
+                        continue
+                    if change["op"] == "save":
+                        self._replace(objs, cls(**change["obj"]))
+                    else:
+                        self._discard(objs, change["id"])
+        state["offset"] += end
+
+    @staticmethod
+    def _replace(objs: dict, obj: TypeVar('Base')):
+        """ Store obj in place of the object with its id, under the
+        write lock
+        """
+        stored = objs.get(obj.id)
+        if stored is not None and stored is not obj:
+            stored._unindex_all()
+        objs[obj.id] = obj
+        obj._index_all()
+
+    @staticmethod
+    def _discard(objs: dict, obj_id: str) -> TypeVar('Base'):
+        """ Remove the object with this id, under the write lock
+        """
+        stored = objs.pop(obj_id, None)
+        if stored is not None:
+            stored._unindex_all()
+        return stored
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object by ID
+        """
+        self.sync(cls)
+        # a single lookup, atomic without the lock
+        return base.DATA[cls.__name__].get(id)
+
+    def search(self, cls: type,
+               attributes: dict = {}) -> List[TypeVar('Base')]:
+        """ Search all objects with matching attributes, through the
+        secondary indexes when the query covers an indexed attribute
+        """
+        s_class = cls.__name__
+        self.sync(cls)
+
+        def _search(obj):
+            if len(attributes) == 0:
+                return True
+            for k, v in attributes.items():
+                if (getattr(obj, k) != v):
+                    return False
+            return True
+
+        # a snapshot under the lock, compared outside of it
+        indexed = [k for k in attributes.keys() if k in cls.INDEXES]
+        with base.lock(s_class).read():
+            objs = base.DATA[s_class]
+            snapshot = None
+            if len(indexed) > 0:
+                try:
+                    buckets = [base.INDEX.get(s_class, {}).get(k, {})
+                               .get(attributes[k], {}) for k in indexed]
+                    snapshot = [objs[obj_id]
+                                for obj_id in min(buckets, key=len)]
+                except TypeError:
+                    # unhashable value, only a scan can compare it
+                    pass
+            if snapshot is None:
+                snapshot = list(objs.values())
+        return list(filter(_search, snapshot))
+
+    def query(self, query: Query) -> Iterator[TypeVar('Base')]:
+        """ Objects matching a Query, compared one by one as they are
+        consumed
+        """
+        return query.page(obj for obj in self._candidates(query)
+                          if query.match(obj))
+
+    def query_count(self, query: Query) -> int:
+        """ Number of objects a Query yields
+        """
+        return query.paged_count(sum(1 for obj in self._candidates(query)
+                                     if query.match(obj)))
+
+    def _candidates(self, query: Query) -> List[TypeVar('Base')]:
+        """ Objects a Query may match: the smallest index selection of
+        its eq and in predicates, all objects otherwise
+        """
+        cls = query.cls
+        s_class = cls.__name__
+        self.sync(cls)
+        with base.lock(s_class).read():
+            objs = base.DATA[s_class]
+            indexes = base.INDEX.get(s_class, {})
+            best = None
+            for attr, op, value in query.predicates:
+                if attr not in cls.INDEXES or op not in ('eq', 'in'):
+                    continue
+                values = (value,) if op == 'eq' else value
+                try:
+                    ids = {}
+                    for v in values:
+                        ids.update(indexes.get(attr, {}).get(v, {}))
+                except TypeError:
+                    # unhashable value, only a scan can compare it
+                    continue
+                if best is None or len(ids) < len(best):
+                    best = ids
+            if best is None:
+                return list(objs.values())
+            return [objs[obj_id] for obj_id in best]
+
+    def save(self, obj: TypeVar('Base')):
+        """ Store an object, keep the indexes, then persist
+        """
+        cls = obj.__class__
+        with base.lock(cls.__name__).write():
+            objs = base.DATA[cls.__name__]
+            previous = objs.get(obj.id)
+            changes = getattr(self._batch, "changes", None)
+            if changes is not None:
+                previous = self._before(previous)
+                self._hold(cls.__name__, obj.id, previous)
+            self._replace(objs, obj)
+            self._pending.setdefault(cls.__name__, set()).add(obj.id)
+        if changes is not None:
+            changes.append(("save", obj, previous))
+            return
+        # files are written outside the lock
+        if base.JOURNAL_MODE:
+            cls.append_to_journal("save", obj)
+            self._written(cls, [obj.id])
+        else:
+            cls.persist()
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object, keep the indexes, then persist
+        """
+        cls = obj.__class__
+        with base.lock(cls.__name__).write():
+            stored = self._discard(base.DATA[cls.__name__], obj.id)
+            changes = getattr(self._batch, "changes", None)
+            if stored is not None:
+                if changes is not None:
+                    previous = self._before(stored)
+                    self._hold(cls.__name__, obj.id, previous)
+                self._pending.setdefault(cls.__name__, set()).add(obj.id)
+        if stored is None:
+            return
+        if changes is not None:
+            changes.append(("remove", obj, previous))
+            return
+        if base.JOURNAL_MODE:
+            cls.append_to_journal("remove", obj)
+            self._written(cls, [obj.id])
+        else:
+            cls.persist()
+
+    def _written(self, cls: type, ids: List[str]):
+        """ Ids no longer pending, their changes are in the journal
+        """
+        with base.lock(cls.__name__).write():
+            pending = self._pending.get(cls.__name__, set())
+            for obj_id in ids:
+                pending.discard(obj_id)
+
+    def before_change(self, obj: TypeVar('Base')):
+        """ Keep a copy of the state of a stored object before the batch
+        of this thread first changes it
+        """
+        before = getattr(self._batch, "before", None)
+        if before is not None:
+            key = (obj.__class__.__name__, obj.id)
+            if key not in before:
+                with base.lock(key[0]).write():
+                    before[key] = dict(obj._state())
+                    self._hold(key[0], obj.id, before[key])
+
+    def _hold(self, s_class: str, obj_id: str, previous: dict):
+        """ Have snapshots write previous for obj_id until the batch of
+        this thread ends, under the write lock
+        """
+        if (s_class, obj_id) in self._batch.keys:
+            return
+        self._batch.keys.add((s_class, obj_id))
+        held = self._held.setdefault(s_class, {})
+        if obj_id in held:
+            # held first by the batch of another thread
+            held[obj_id][1] += 1
+        else:
+            held[obj_id] = [previous, 1,
+                            obj_id in self._pending.get(s_class, ())]
+
+    def _release(self, keys: set, commit: bool):
+        """ Let snapshots write the objects of an ended batch again.
+        Rolled back, the ids it made pending are written already
+        """
+        classes = {}
+        for s_class, obj_id in keys:
+            classes.setdefault(s_class, []).append(obj_id)
+        for s_class, ids in classes.items():
+            with base.lock(s_class).write():
+                held = self._held[s_class]
+                pending = self._pending.get(s_class, set())
+                for obj_id in ids:
+                    entry = held[obj_id]
+                    entry[1] -= 1
+                    if entry[1] > 0:
+                        continue
+                    del held[obj_id]
+                    if not commit and not entry[2]:
+                        pending.discard(obj_id)
+
+    def _before(self, stored: TypeVar('Base')) -> dict:
+        """ State a stored object had when the batch started, None for
+        no object
+        """
+        if stored is None:
+            return None
+        key = (stored.__class__.__name__, stored.id)
+        before = self._batch.before
+        if key in before:
+            return before[key]
+        return dict(stored._state())
+
+    def begin(self):
+        """ Start a batch, or join the batch of this thread. Its changes
+        show in DATA at once, snapshots written before the end hold the
+        state before them
+        """
+        batch = self._batch
+        batch.depth = getattr(batch, "depth", 0) + 1
+        if batch.depth == 1:
+            batch.changes = []
+            batch.before = {}
+            batch.keys = set()
+            with self._batches_lock:
+                base.OPEN_BATCHES += 1
+
+    def end(self, commit: bool):
+        """ End a batch: one flush per class it changed with commit,
+        the objects stored before rebuilt otherwise
+        """
+        batch = self._batch
+        batch.depth -= 1
+        if batch.depth > 0:
+            return
+        changes, batch.changes, batch.before = batch.changes, None, None
+        keys, batch.keys = batch.keys, None
+        with self._batches_lock:
+            base.OPEN_BATCHES -= 1
+        if not commit:
+            for op, obj, previous in reversed(changes):
+                cls = obj.__class__
+                s_class = cls.__name__
+                with base.lock(s_class).write():
+                    if previous is None:
+                        self._discard(base.DATA[s_class], obj.id)
+                    else:
+                        # from_records may keep the dict it is given
+                        self._replace(base.DATA[s_class], next(
+                            cls.from_records([dict(previous)])))
+            # released once DATA is back as the files have it
+            self._release(keys, False)
+            return
+        self._release(keys, True)
+        classes = {}
+        for op, obj, previous in changes:
+            classes.setdefault(obj.__class__, []).append((op, obj))
+        for cls, cls_changes in classes.items():
+            if base.JOURNAL_MODE:
+                cls.append_batch_to_journal(cls_changes)
+                self._written(cls, [obj.id for op, obj in cls_changes])
+            else:
+                cls.persist()
+
+    def count(self, cls: type) -> int:
+        """ Count all objects
+        """
+        self.sync(cls)
+        return len(base.DATA[cls.__name__].keys())
+
+    def iterate(self, cls: type) -> Iterator[TypeVar('Base')]:
+        """ Yield all objects, from a copy of the current ones
+        """
+        self.sync(cls)
+        with base.lock(cls.__name__).read():
+            return iter(list(base.DATA[cls.__name__].values()))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+""" SQLite storage engine: one table per class, nothing held in memory
+"""
+from datetime import datetime
+from os import path
+from typing import Iterator, List, TypeVar
+import json
+import os
+import re
+import sqlite3
+import threading
+from models import base
+from models.engine.storage import Storage
+from models.query import Query
+
+# attribute names json_extract paths can take as they are
+PLAIN_NAME = re.compile(r'^\w+$')
+# values SQLite compares like Python does
+SQL_TYPES = (str, int, float, bool, type(None))
+
+
+def column_value(value):
+    """ Value of an attribute as stored in an indexed column
+    """
+    if type(value) is datetime:
+        return value.strftime(base.TIMESTAMP_FORMAT)
+    if isinstance(value, SQL_TYPES):
+        return value
+    return json.dumps(value)
+
+
+class SQLiteStorage(Storage):
+    """ Every class is a table holding the id, the to_json(True) of the
+    object and one indexed column per attribute of its INDEXES.
+    Connections are per thread, in WAL mode so readers never wait
+    for a writer
+    """
+
+    def __init__(self, db_path: str):
+        """ Initialize the engine, connections open on first use
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tables = set()
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Connection of this thread, a new one after a fork
+        """
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            cnx = sqlite3.connect(self.db_path, timeout=30)
+            cnx.execute("PRAGMA journal_mode=WAL")
+            cnx.execute("PRAGMA synchronous=NORMAL")
+            local.cnx, local.pid = cnx, os.getpid()
+        return local.cnx
+
+    def _table(self, cls: type) -> sqlite3.Connection:
+        """ Connection of this thread, with the table of cls created
+        and its indexed columns added
+        """
+        cnx = self._connection()
+        s_class = cls.__name__
+        if s_class in self._tables:
+            return cnx
+        with self._lock:
+            cnx.execute('CREATE TABLE IF NOT EXISTS "{}" ('
+                        'id TEXT PRIMARY KEY, data TEXT NOT NULL)'
+                        .format(s_class))
+            columns = {row[1] for row in cnx.execute(
+                'PRAGMA table_info("{}")'.format(s_class))}
+            for attr in cls.INDEXES:
+                if attr in columns:
+                    continue
+                cnx.execute('ALTER TABLE "{0}" ADD COLUMN "{1}"'
+                            .format(s_class, attr))
+                cnx.execute('UPDATE "{0}" SET "{1}" = '
+                            'json_extract(data, \'$."{1}"\')'
+                            .format(s_class, attr))
+                cnx.execute('CREATE INDEX IF NOT EXISTS "{0}_{1}" '
+                            'ON "{0}" ("{1}")'.format(s_class, attr))
+            if getattr(self._local, "depth", 0) == 0:
+                cnx.commit()
+                self._tables.add(s_class)
+            # in a batch, the table is only there once it commits
+        return cnx
+
+    @staticmethod
+    def _upsert_sql(cls: type) -> str:
+        """ Statement storing one object, the same text every time so
+        sqlite3 reuses the prepared statement
+        """
+        columns = ''.join(', "{}"'.format(a) for a in cls.INDEXES)
+        return 'INSERT OR REPLACE INTO "{}" (id, data{}) VALUES (?, ?{})' \
+            .format(cls.__name__, columns, ', ?' * len(cls.INDEXES))
+
+    @staticmethod
+    def _row(obj: TypeVar('Base')) -> tuple:
+        """ Parameters of _upsert_sql for obj
+        """
+        return (obj.id, obj.to_json_bytes(True).decode()) + tuple(
+            column_value(getattr(obj, a, None)) for a in obj.INDEXES)
+
+    def load(self, cls: type, workers: int = None):
+        """ Create the table of cls, importing the JSON file of the file
+        engine when the table is still empty
+        """
+        cnx = self._table(cls)
+        file_path = ".db_{}.json".format(cls.__name__)
+        if not path.exists(file_path) or cnx.execute(
+                'SELECT 1 FROM "{}" LIMIT 1'.format(cls.__name__)).fetchone():
+            return
+        with open(file_path, 'r') as f:
+            objs_json = json.load(f)
+        with cnx:
+            cnx.executemany(self._upsert_sql(cls), (
+                self._row(cls(**obj)) for obj in objs_json.values()))
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object by ID
+        """
+        row = self._table(cls).execute(
+            'SELECT data FROM "{}" WHERE id = ?'.format(cls.__name__),
+            (id,)).fetchone()
+        if row is None:
+            return None
+        return cls(**json.loads(row[0]))
+
+    def search(self, cls: type,
+               attributes: dict = {}) -> List[TypeVar('Base')]:
+        """ Search all objects with matching attributes
+        """
+        return list(self.query(Query(cls, attributes)))
+
+    @staticmethod
+    def _expression(cls: type, attr: str) -> str:
+        """ SQL expression of an attribute, None if SQL can't read it
+        """
+        if attr == 'id' or attr in cls.INDEXES:
+            return '"{}"'.format(attr)
+        if PLAIN_NAME.match(attr):
+            return 'json_extract(data, \'$.{}\')'.format(attr)
+        return None
+
+    def _where(self, query: Query) -> tuple:
+        """ WHERE clause and parameters of the predicates SQL can run,
+        and whether it ran them all
+        """
+        where = []
+        params = []
+        complete = True
+        for attr, op, value in query.predicates:
+            expression = self._expression(query.cls, attr)
+            values = value if op in ('in', 'range') else (value,)
+            if expression is None or not all(
+                    v is None or isinstance(v, SQL_TYPES) or
+                    type(v) is datetime for v in values):
+                complete = False
+                continue
+            values = [column_value(v) for v in values]
+            if op == 'eq':
+                where.append('{} IS ?'.format(expression))
+            elif op == 'prefix':
+                if type(value) is not str:
+                    complete = False
+                    continue
+                where.append("typeof({0}) = 'text' AND "
+                             "substr({0}, 1, ?) = ?".format(expression))
+                values = [len(value), value]
+            elif op == 'in':
+                where.append('{} IN ({})'.format(
+                    expression, ', '.join('?' * len(values))))
+            else:
+                low, high = values
+                where.append('{} IS NOT NULL'.format(expression))
+                if low is not None:
+                    where.append('{} >= ?'.format(expression))
+                if high is not None:
+                    where.append('{} < ?'.format(expression))
+                values = [v for v in values if v is not None]
+            params.extend(values)
+        sql = ' WHERE ' + ' AND '.join(where) if where else ''
+        return sql, params, complete
+
+    def query(self, query: Query) -> Iterator[TypeVar('Base')]:
+        """ Objects matching a Query: ordered and paged by SQL when it
+        runs all the predicates, rows read as they are consumed
+        """
+        cls = query.cls
+        where, params, complete = self._where(query)
+        order = 'rowid'
+        if query.order is not None:
+            order = self._expression(cls, query.order)
+        sql = 'SELECT data FROM "{}"{}'.format(cls.__name__, where)
+        if not complete or order is None:
+            cursor = self._table(cls).execute(sql + ' ORDER BY rowid',
+                                              params)
+            return query.page(obj for obj in (cls(**json.loads(data))
+                                              for data, in cursor)
+                              if query.match(obj))
+        if query.order is not None:
+            direction = ' DESC' if query.reverse else ''
+            order = '{0} IS NULL{1}, {0}{1}'.format(order, direction)
+        sql += ' ORDER BY {} LIMIT ? OFFSET ?'.format(order)
+        limit = -1 if query.limit_count is None else query.limit_count
+        cursor = self._table(cls).execute(
+            sql, params + [limit, query.offset_count])
+        # compared again: SQL and Python equality may differ on types
+        return (obj for obj in (cls(**json.loads(data))
+                                for data, in cursor) if query.match(obj))
+
+    def query_count(self, query: Query) -> int:
+        """ Number of objects a Query yields, without building them when
+        SQL runs all the predicates
+        """
+        where, params, complete = self._where(query)
+        if not complete:
+            return super().query_count(query)
+        row = self._table(query.cls).execute(
+            'SELECT COUNT(*) FROM "{}"{}'.format(query.cls.__name__, where),
+            params).fetchone()
+        return query.paged_count(row[0])
+
+    def save(self, obj: TypeVar('Base')):
+        """ Insert or replace the row of an object
+        """
+        cls = obj.__class__
+        self._write(cls, self._upsert_sql(cls), self._row(obj))
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete the row of an object
+        """
+        cls = obj.__class__
+        self._write(cls, 'DELETE FROM "{}" WHERE id = ?'.format(
+            cls.__name__), (obj.id,))
+
+    def _write(self, cls: type, sql: str, params: tuple):
+        """ Run a statement, committed now unless in a batch
+        """
+        cnx = self._table(cls)
+        if getattr(self._local, "depth", 0) > 0:
+            cnx.execute(sql, params)
+            return
+        with cnx:
+            cnx.execute(sql, params)
+
+    def begin(self):
+        """ Start a batch: one transaction for the statements of this
+        thread, or join the batch already started
+        """
+        self._connection()
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+
+    def end(self, commit: bool):
+        """ End a batch: commit or roll back its transaction
+        """
+        self._local.depth -= 1
+        if self._local.depth > 0:
+            return
+        if commit:
+            self._connection().commit()
+        else:
+            self._connection().rollback()
+
+    def count(self, cls: type) -> int:
+        """ Count all objects
+        """
+        return self._table(cls).execute(
+            'SELECT COUNT(*) FROM "{}"'.format(cls.__name__)).fetchone()[0]
+
+    def iterate(self, cls: type) -> Iterator[TypeVar('Base')]:
+        """ Yield all objects, reading the rows as they are consumed
+        """
+        cursor = self._table(cls).execute(
+            'SELECT data FROM "{}" ORDER BY rowid'.format(cls.__name__))
+        for data, in cursor:
+            yield cls(**json.loads(data))
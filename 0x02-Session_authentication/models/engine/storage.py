@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+""" Storage engine interface
+"""
+from typing import Iterator, List, TypeVar
+from models import base
+
+
+class Storage():
+    """ Where Base keeps its objects: every engine implements these
+    """
+
+    def load(self, cls: type, workers: int = None):
+        """ Get the objects of cls ready to be served
+        """
+        raise NotImplementedError
+
+    def dump(self, cls: type):
+        """ Write all objects of cls to the JSON file of the file engine
+        """
+        with base.file_lock(cls.__name__):
+            base.write_snapshot(cls.__name__, ((obj.id, obj)
+                                               for obj in self.iterate(cls)))
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object by ID, None if missing
+        """
+        raise NotImplementedError
+
+    def search(self, cls: type,
+               attributes: dict = {}) -> List[TypeVar('Base')]:
+        """ Return all objects with matching attributes
+        """
+        raise NotImplementedError
+
+    def save(self, obj: TypeVar('Base')):
+        """ Store or replace an object
+        """
+        raise NotImplementedError
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object
+        """
+        raise NotImplementedError
+
+    def begin(self):
+        """ Start a batch, or join the batch of this thread
+        """
+        raise NotImplementedError
+
+    def end(self, commit: bool):
+        """ End a batch: persist its changes with commit, undo them
+        otherwise
+        """
+        raise NotImplementedError
+
+    def before_change(self, obj: TypeVar('Base')):
+        """ Called before an attribute of a stored object is set while
+        OPEN_BATCHES is not 0
+        """
+
+    def count(self, cls: type) -> int:
+        """ Count all objects of cls
+        """
+        raise NotImplementedError
+
+    def iterate(self, cls: type) -> Iterator[TypeVar('Base')]:
+        """ Yield all objects of cls
+        """
+        raise NotImplementedError
+
+    def query(self, query: 'Query') -> Iterator[TypeVar('Base')]:
+        """ Objects matching a Query, yielded as they are consumed
+        """
+        return query.page(obj for obj in self.iterate(query.cls)
+                          if query.match(obj))
+
+    def query_count(self, query: 'Query') -> int:
+        """ Number of objects a Query yields
+        """
+        return query.paged_count(sum(1 for obj in self.iterate(query.cls)
+                                     if query.match(obj)))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+""" Query module: lazy queries over the objects of a model
+"""
+from itertools import islice
+from typing import Iterable, Iterator, TypeVar
+
+
+class Query():
+    """ Lazy query: predicates, order, limit and offset are only
+    recorded, nothing runs until the query is iterated or counted.
+    Every method returns a new query, the query itself never changes.
+
+    Operators of where:
+      - eq: attribute == value
+      - prefix: string attribute starting with value
+      - in: attribute in value, a list or a tuple
+      - range: low <= attribute < high for value (low, high), None
+        for an open end
+    """
+    OPERATORS = ('eq', 'prefix', 'in', 'range')
+
+    def __init__(self, cls: type, attributes: dict = {}):
+        """ Initialize a query on all objects of cls, with an equality
+        predicate per attribute like search
+        """
+        self.cls = cls
+        self.predicates = tuple((k, 'eq', v) for k, v in attributes.items())
+        self.order = None
+        self.reverse = False
+        self.limit_count = None
+        self.offset_count = 0
+
+    def _copy(self, **changes) -> 'Query':
+        """ New query with some fields changed
+        """
+        query = Query(self.cls)
+        query.__dict__.update(self.__dict__)
+        query.__dict__.update(changes)
+        return query
+
+    def where(self, attr: str, op: str, value) -> 'Query':
+        """ Keep the objects whose attr matches value with op
+        """
+        if op not in self.OPERATORS:
+            raise ValueError("unknown operator {}".format(op))
+        if op == 'in':
+            value = tuple(value)
+        elif op == 'range':
+            low, high = value
+            value = (low, high)
+        return self._copy(predicates=self.predicates + ((attr, op, value),))
+
+    def order_by(self, attr: str, reverse: bool = False) -> 'Query':
+        """ Sort on attr, None values last (first when reversed)
+        """
+        return self._copy(order=attr, reverse=reverse)
+
+    def limit(self, count: int) -> 'Query':
+        """ Keep at most count objects
+        """
+        return self._copy(limit_count=count)
+
+    def offset(self, count: int) -> 'Query':
+        """ Skip the first count objects
+        """
+        return self._copy(offset_count=count)
+
+    def __iter__(self) -> Iterator[TypeVar('Base')]:
+        """ Run the query, the objects come as they are consumed
+        """
+        from models.base import storage
+        return iter(storage().query(self))
+
+    def count(self) -> int:
+        """ Number of objects the query yields
+        """
+        from models.base import storage
+        return storage().query_count(self)
+
+    def first(self) -> TypeVar('Base'):
+        """ First object of the query, None if there is none
+        """
+        return next(iter(self.limit(1)), None)
+
+    def match(self, obj: TypeVar('Base')) -> bool:
+        """ Whether obj satisfies all the predicates
+        """
+        for attr, op, value in self.predicates:
+            current = getattr(obj, attr)
+            if op == 'eq':
+                if current != value:
+                    return False
+            elif op == 'prefix':
+                if type(current) is not str or \
+                        not current.startswith(value):
+                    return False
+            elif op == 'in':
+                if current not in value:
+                    return False
+            else:
+                low, high = value
+                if current is None or \
+                        (low is not None and current < low) or \
+                        (high is not None and not current < high):
+                    return False
+        return True
+
+    def sort_key(self, obj: TypeVar('Base')) -> tuple:
+        """ Key of order_by, None values after all others
+        """
+        value = getattr(obj, self.order, None)
+        return (value is None, value)
+
+    def page(self, objs: Iterable[TypeVar('Base')]) \
+            -> Iterator[TypeVar('Base')]:
+        """ Order, offset and limit matching objects
+        """
+        if self.order is not None:
+            objs = sorted(objs, key=self.sort_key, reverse=self.reverse)
+        stop = None
+        if self.limit_count is not None:
+            stop = self.offset_count + self.limit_count
+        return islice(objs, self.offset_count, stop)
+
+    def paged_count(self, matches: int) -> int:
+        """ Number of objects left of matches by offset and limit
+        """
+        count = max(0, matches - self.offset_count)
+        if self.limit_count is not None:
+            count = min(count, self.limit_count)
+        return count
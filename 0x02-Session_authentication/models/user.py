@@ -2,12 +2,14 @@
 """ User module
 """
 import hashlib
-from models.base import Base
+from models.base import Base, COMPACT_MODELS
+from models.compact import compact
 
 
 class User(Base):
     """ User class
     """
+    INDEXES = ('email',)
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User instance
@@ -57,3 +59,8 @@ class User(Base):
             return "{}".format(self.last_name)
         else:
             return "{} {}".format(self.first_name, self.last_name)
+
+
+if COMPACT_MODELS:
+    # same name and files, attributes in slots
+    User = compact(User, interned=('first_name', 'last_name'))
@@ -3,11 +3,74 @@
 Authentication module
 """
 import bcrypt
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import os
+import time
 import uuid
 from db import DB
 from user import User
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.exc import NoResultFound
 
+# floor of the calibrated cost, even on a slow or busy host
+MIN_ROUNDS = 10
+MAX_ROUNDS = 16
+# cost when BCRYPT_BUDGET_MS is not set, the bcrypt.gensalt default
+DEFAULT_ROUNDS = 12
+# hashes timed per cost, the fastest one counts
+SAMPLES = 3
+_rounds = None
+_rehasher = ThreadPoolExecutor(max_workers=1)
+
+
+def _calibrate_rounds(budget_ms: float = None) -> int:
+    """Picks the highest bcrypt cost hashing within a latency budget.
+
+    Args:
+        budget_ms (float): The hashing time to fit in, BCRYPT_BUDGET_MS
+                           by default. Without either, DEFAULT_ROUNDS.
+
+    Returns:
+        int: The cost now used by _hash_password.
+    """
+    global _rounds
+    if budget_ms is None and "BCRYPT_BUDGET_MS" not in os.environ:
+        _rounds = DEFAULT_ROUNDS
+        return _rounds
+    if budget_ms is None:
+        budget_ms = float(os.environ["BCRYPT_BUDGET_MS"])
+    rounds = MIN_ROUNDS
+    elapsed = _time_hash(rounds)
+    # one more round, twice the time
+    while rounds < MAX_ROUNDS and elapsed * 2 <= budget_ms:
+        elapsed = _time_hash(rounds + 1)
+        if elapsed > budget_ms:
+            break
+        rounds += 1
+    _rounds = rounds
+    return rounds
+
+
+def _time_hash(rounds: int) -> float:
+    """Returns the milliseconds a bcrypt hash takes at a given cost,
+    the fastest of SAMPLES hashes.
+    """
+    timings = []
+    for _ in range(SAMPLES):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", bcrypt.gensalt(rounds))
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def _get_rounds() -> int:
+    """Returns the calibrated bcrypt cost, calibrating on first use.
+    """
+    if _rounds is None:
+        return _calibrate_rounds()
+    return _rounds
+
 
 def _hash_password(password: str) -> bytes:
     """Hashes a password using bcrypt.
@@ -18,12 +81,24 @@ def _hash_password(password: str) -> bytes:
     Returns:
         bytes: The salted hash of the password.
     """
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(_get_rounds())
     hashed_password = bcrypt.hashpw(
         password.encode('utf-8'), salt)
     return hashed_password
 
 
+def _report_rehash(future: Future) -> None:
+    """Logs the error of a failed background rehash.
+
+    Args:
+        future (Future): The finished rehash.
+    """
+    error = future.exception()
+    if error is not None:
+        logging.getLogger(__name__).error(
+            "password rehash failed", exc_info=error)
+
+
 def _generate_uuid() -> str:
     """Generates a new UUID.
 
@@ -39,6 +114,7 @@ class Auth:
 
     def __init__(self):
         self._db = DB()
+        _get_rounds()
 
     def register_user(self, email: str, password: str) -> User:
         """Registers a new user.
@@ -82,12 +158,32 @@ class Auth:
         try:
             user = self._db.find_user_by(email=email)
             hashed_pw = user.hashed_password
-            return bcrypt.checkpw(password.encode('utf-8'),
-                                  hashed_pw)
+            valid = bcrypt.checkpw(password.encode('utf-8'),
+                                   hashed_pw)
         except NoResultFound:
             return False
         except Exception as e:
             return False
+        if valid and int(hashed_pw.split(b"$")[2]) < _get_rounds():
+            _rehasher.submit(self._rehash, user.id, password) \
+                .add_done_callback(_report_rehash)
+        return valid
+
+    def _rehash(self, user_id: int, password: str) -> None:
+        """Stores a new hash of a password whose hash has an outdated
+           cost. Runs off the request path, in its own session.
+
+        Args:
+            user_id (int): The ID of the user.
+            password (str): The password, already verified.
+        """
+        session = Session(bind=self._db._engine)
+        try:
+            session.query(User).filter_by(id=user_id).update(
+                {"hashed_password": _hash_password(password)})
+            session.commit()
+        finally:
+            session.close()
 
     def create_session(self, email: str) -> str:
         """Creates a session for a user.